@@ -1,4 +1,3 @@
-import chdb
 import config
 import handlers
 
@@ -8,6 +7,7 @@ from flask.ext.compress import Compress
 from flask.ext.mobility import Mobility
 
 import os
+from datetime import datetime
 
 # Cache duration for snippets.
 # Since each page contains a link to the next one, even when no category is
@@ -27,6 +27,9 @@ Compress(app)
 debug = 'DEBUG' in os.environ
 if not debug:
     flask_sslify.SSLify(app, permanent = True)
+# Serve snippets from an in-memory copy of the database, see
+# handlers/snapshot.py.
+app.config['SNAPSHOT_CACHE'] = 'SNAPSHOT_CACHE' in os.environ
 Mobility(app)
 
 @app.route('/')
@@ -77,18 +80,17 @@ def log_request(response):
     referrer = flask.request.referrer
     status_code = response.status_code
 
-    with handlers.get_stats_db() as cursor, chdb.ignore_warnings():
-        cursor.execute('INSERT INTO requests VALUES '
-            '(NOW(), %s, %s, %s, %s, %s, %s, %s, %s)',
-            (lang_code, id, cat, url, prefetch, user_agent,
-             status_code, referrer))
+    # Written to the database in the background, see handlers/requestlog.py.
+    # The timestamp is in UTC, as the stats pages compare it with UTC_DATE()
+    # in the database, whose time zone may differ from ours.
+    handlers.request_logger.log(
+        (datetime.utcnow(), lang_code, id, cat, url, prefetch, user_agent,
+         status_code, referrer))
     return response
 
 @app.teardown_appcontext
-def close_db(exception):
-    db = getattr(flask.g, '_db', None)
-    if db is not None:
-        db.close()
+def release_db(exception):
+    handlers.release_dbs()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
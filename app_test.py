@@ -102,5 +102,13 @@ class CitationHuntTest(unittest.TestCase):
 
             self.assertEquals(response.content_encoding, 'gzip')
 
+class CitationHuntSnapshotCacheTest(CitationHuntTest):
+    def setUp(self):
+        super(CitationHuntSnapshotCacheTest, self).setUp()
+        app.app.config['SNAPSHOT_CACHE'] = True
+
+    def tearDown(self):
+        app.app.config['SNAPSHOT_CACHE'] = False
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,12 +2,22 @@ import MySQLdb
 
 import config
 import warnings
+import threading
 import os.path as op
 import contextlib
 
 ch_my_cnf = op.join(op.dirname(op.realpath(__file__)), 'ch.my.cnf')
 wp_my_cnf = op.join(op.dirname(op.realpath(__file__)), 'wp.my.cnf')
 
+def _wp_my_cnf(lang_code):
+    # Prefer a config specific to the language, if any, so that languages
+    # whose replicas are on different hosts can be updated at the same time.
+    localized_wp_my_cnf = op.join(
+        op.dirname(wp_my_cnf), 'wp_%s.my.cnf' % lang_code)
+    if op.exists(localized_wp_my_cnf):
+        return localized_wp_my_cnf
+    return wp_my_cnf
+
 class RetryingConnection(object):
     '''
     Wraps a MySQLdb connection, handling retries as needed.
@@ -45,6 +55,73 @@ class RetryingConnection(object):
     def __getattr__(self, name):
         return getattr(self.conn, name)
 
+class ConnectionPool(object):
+    '''
+    A bounded, thread-safe pool of RetryingConnections, meant to be shared by
+    the requests served by a process so they don't each pay for connecting to
+    and setting up the database.
+
+    acquire() blocks while max_connections connections are in use. Idle
+    connections are pinged before being handed out again, and reconnected
+    from scratch if the server has closed them in the meantime.
+    '''
+
+    def __init__(self, connect, max_connections):
+        def connect_with_autocommit():
+            # Pooled connections live across requests, so don't let them
+            # keep a transaction (and its stale view of the tables) open.
+            db = connect()
+            db.autocommit(True)
+            return db
+        self._connect = connect_with_autocommit
+        self._idle = []
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(max_connections)
+
+    def acquire(self):
+        self._available.acquire()
+        try:
+            with self._lock:
+                db = self._idle.pop() if self._idle else None
+            if db is None:
+                db = RetryingConnection(self._connect)
+            else:
+                self._check_health(db)
+        except:
+            self._available.release()
+            raise
+        return db
+
+    def release(self, db):
+        with self._lock:
+            self._idle.append(db)
+        self._available.release()
+
+    def _check_health(self, db):
+        thread_id = db.thread_id()
+        try:
+            db.ping()
+            # ping() reconnects silently, but the new connection doesn't have
+            # the settings and the database selected by our connect function
+            healthy = db.thread_id() == thread_id
+        except MySQLdb.OperationalError:
+            healthy = False
+        if not healthy:
+            db._do_connect()
+
+# Maximum number of connections to each database in a ConnectionPool
+POOL_MAX_CONNECTIONS = 8
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(key, connect):
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(connect, POOL_MAX_CONNECTIONS)
+    return pool
+
 @contextlib.contextmanager
 def ignore_warnings():
     warnings.filterwarnings('ignore', category = MySQLdb.Warning)
@@ -69,12 +146,13 @@ def _ensure_database(db, database, lang_code):
                 'CREATE DATABASE IF NOT EXISTS %s CHARACTER SET utf8mb4' % dbname)
         cursor.execute('USE %s' % dbname)
 
+def _connect_and_initialize_db(lang_code):
+    db = _connect(ch_my_cnf)
+    _ensure_database(db, 'citationhunt', lang_code)
+    return db
+
 def init_db(lang_code):
-    def connect_and_initialize():
-        db = _connect(ch_my_cnf)
-        _ensure_database(db, 'citationhunt', lang_code)
-        return db
-    return RetryingConnection(connect_and_initialize)
+    return RetryingConnection(lambda: _connect_and_initialize_db(lang_code))
 
 def init_scratch_db():
     cfg = config.get_localized_config()
@@ -84,37 +162,100 @@ def init_scratch_db():
         return db
     return RetryingConnection(connect_and_initialize)
 
-def init_stats_db():
-    def connect_and_initialize():
-        db = _connect(ch_my_cnf)
-        _ensure_database(db, 'stats', 'global')
-        with db as cursor, ignore_warnings():
+def _ensure_index(cursor, table, index, columns):
+    cursor.execute('''
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE table_schema = DATABASE() AND table_name = %s AND
+        index_name = %s''', (table, index))
+    if not cursor.fetchone()[0]:
+        cursor.execute(
+            'ALTER TABLE %s ADD INDEX %s (%s)' % (table, index, columns))
+
+def _ensure_foreign_key(cursor, table, column, ref_table, ref_column):
+    cursor.execute('''
+        SELECT COUNT(*) FROM information_schema.KEY_COLUMN_USAGE
+        WHERE table_schema = DATABASE() AND table_name = %s AND
+        column_name = %s AND referenced_table_name = %s''',
+        (table, column, ref_table))
+    if not cursor.fetchone()[0]:
+        cursor.execute(
+            'ALTER TABLE %s ADD FOREIGN KEY (%s) REFERENCES %s(%s) '
+            'ON DELETE CASCADE' % (table, column, ref_table, ref_column))
+
+def _ensure_column(cursor, table, column, definition):
+    cursor.execute('''
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE table_schema = DATABASE() AND table_name = %s AND
+        column_name = %s''', (table, column))
+    if not cursor.fetchone()[0]:
+        cursor.execute(
+            'ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition))
+
+def _connect_and_initialize_stats_db():
+    db = _connect(ch_my_cnf)
+    _ensure_database(db, 'stats', 'global')
+    with db as cursor, ignore_warnings():
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS requests (
+            ts DATETIME, lang_code VARCHAR(4), snippet_id VARCHAR(128),
+            category_id VARCHAR(128), url VARCHAR(768), prefetch BOOLEAN,
+            user_agent VARCHAR(1024), status_code INTEGER,
+            referrer VARCHAR(128), is_crawler BOOLEAN,
+            INDEX ts (ts), INDEX is_crawler (is_crawler))
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+        # Successful requests aggregated per day, see
+        # scripts/update_daily_requests.py
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_requests (
+            dt DATE, lang_code VARCHAR(4), category_id VARCHAR(128),
+            referrer VARCHAR(128), user_agent VARCHAR(1024),
+            is_crawler BOOLEAN, requests INTEGER, snippets INTEGER,
+            INDEX dt (dt), INDEX lang_code_dt (lang_code, dt))
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+        # Create per-language views for convenience
+        for lang_code in config.lang_code_to_config:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS requests (
-                ts DATETIME, lang_code VARCHAR(4), snippet_id VARCHAR(128),
-                category_id VARCHAR(128), url VARCHAR(768), prefetch BOOLEAN,
-                user_agent VARCHAR(1024), status_code INTEGER,
-                referrer VARCHAR(128)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-            ''')
-            # Create per-language views for convenience
-            for lang_code in config.lang_code_to_config:
-                cursor.execute('''
-                    CREATE OR REPLACE VIEW requests_''' + lang_code +
-                    ''' AS SELECT * FROM requests WHERE lang_code = %s
-                ''', (lang_code,))
-        return db
-    return RetryingConnection(connect_and_initialize)
+                CREATE OR REPLACE VIEW requests_''' + lang_code +
+                ''' AS SELECT * FROM requests WHERE lang_code = %s
+            ''', (lang_code,))
+    return db
+
+def init_stats_db():
+    return RetryingConnection(_connect_and_initialize_stats_db)
+
+def upgrade_stats_db(cursor):
+    '''
+    Add the columns and indexes that are missing from a requests table
+    created by an older version.
+
+    This alters a large table that the web app keeps writing to, so rather
+    than on every new connection, it's done by
+    scripts/update_daily_requests.py, of which only one runs at a time.
+    '''
+
+    _ensure_index(cursor, 'requests', 'ts', 'ts')
+    _ensure_column(cursor, 'requests', 'is_crawler', 'BOOLEAN')
+    _ensure_index(cursor, 'requests', 'is_crawler', 'is_crawler')
+
+def get_db_pool(lang_code):
+    return _get_pool(('citationhunt', lang_code),
+        lambda: _connect_and_initialize_db(lang_code))
+
+def get_stats_db_pool():
+    return _get_pool(('stats', 'global'), _connect_and_initialize_stats_db)
 
 def init_wp_replica_db():
     cfg = config.get_localized_config()
     def connect_and_initialize():
-        db = _connect(wp_my_cnf)
+        db = _connect(_wp_my_cnf(cfg.lang_code))
         with db as cursor:
             cursor.execute('USE ' + cfg.database)
         return db
     return RetryingConnection(connect_and_initialize)
 
-def reset_scratch_db():
+def reset_scratch_db(foreign_keys = True):
     cfg = config.get_localized_config()
     db = init_db(cfg.lang_code)
     with db as cursor:
@@ -123,7 +264,24 @@ def reset_scratch_db():
             cursor.execute('DROP DATABASE IF EXISTS ' + dbname)
         cursor.execute('CREATE DATABASE %s CHARACTER SET utf8mb4' % dbname)
         cursor.execute('USE ' + dbname)
-    create_tables(db)
+    create_tables(db, foreign_keys)
+    return db
+
+def copy_db_to_scratch(tables):
+    '''
+    Replace the contents of the given tables in the scratch database with
+    those in the CitationHunt database, so that it can be updated
+    incrementally rather than rebuilt from scratch.
+    '''
+
+    cfg = config.get_localized_config()
+    db = init_scratch_db()
+    chname = _make_tools_labs_dbname(db, 'citationhunt', cfg.lang_code)
+    with db as cursor:
+        for table in tables:
+            cursor.execute('DELETE FROM ' + table)
+            cursor.execute('INSERT INTO %s SELECT * FROM %s.%s' % (
+                table, chname, table))
     return db
 
 def install_scratch_db():
@@ -135,6 +293,13 @@ def install_scratch_db():
     chname = _make_tools_labs_dbname(db, 'citationhunt', cfg.lang_code)
     scname = _make_tools_labs_dbname(db, 'scratch', cfg.lang_code)
     with db as cursor:
+        # bump the generation so servers caching the current tables know to
+        # reload them after the swap
+        cursor.execute('''
+            INSERT INTO %s.generation SELECT COALESCE(MAX(id), 0) + 1, NOW()
+            FROM %s.generation
+        ''' % (scname, chname))
+
         # generate a sql query that will atomically swap tables in
         # 'citationhunt' and 'scratch'. Modified from:
         # http://blog.shlomoid.com/2010/02/emulating-missing-rename-database.html
@@ -151,7 +316,30 @@ def install_scratch_db():
         cursor.execute(rename_stmt)
         cursor.execute('DROP DATABASE ' + scname)
 
-def create_tables(db):
+# The foreign keys in the tables created by create_tables, as (table, column,
+# referenced table, referenced column) tuples. All of them cascade on delete.
+FOREIGN_KEYS = [
+    ('articles_categories', 'article_id', 'articles', 'page_id'),
+    ('articles_categories', 'category_id', 'categories', 'id'),
+    ('snippets', 'article_id', 'articles', 'page_id'),
+    ('snippets_links', 'prev', 'snippets', 'id'),
+    ('snippets_links', 'next', 'snippets', 'id'),
+    ('snippets_links', 'cat_id', 'categories', 'id'),
+    ('snippets_positions', 'snippet_id', 'snippets', 'id'),
+]
+
+def create_foreign_keys(db):
+    '''
+    Add whichever of FOREIGN_KEYS are missing. Tables load faster without
+    foreign keys (and their indexes), so create_tables can leave them out, and
+    this can be called after loading.
+    '''
+
+    with db as cursor, ignore_warnings():
+        for table, column, ref_table, ref_column in FOREIGN_KEYS:
+            _ensure_foreign_key(cursor, table, column, ref_table, ref_column)
+
+def create_tables(db, foreign_keys = True):
     cfg = config.get_localized_config()
     with db as cursor, ignore_warnings():
         cursor.execute('''
@@ -161,30 +349,48 @@ def create_tables(db):
         cursor.execute('''
             INSERT IGNORE INTO categories VALUES("unassigned", "unassigned")
         ''')
+        # The revision and a hash of the wikitext each article was parsed
+        # from, so incremental updates can tell which ones changed
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS articles (page_id VARCHAR(128)
-            PRIMARY KEY, url VARCHAR(512), title VARCHAR(512))
+            PRIMARY KEY, url VARCHAR(512), title VARCHAR(512),
+            rev_id INTEGER UNSIGNED, text_hash CHAR(40))
             ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
+        _ensure_column(cursor, 'articles', 'rev_id', 'INTEGER UNSIGNED')
+        _ensure_column(cursor, 'articles', 'text_hash', 'CHAR(40)')
+        # Same, for the pages that were parsed but had no snippets
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS articles_without_snippets (
+            page_id VARCHAR(128) PRIMARY KEY, rev_id INTEGER UNSIGNED,
+            text_hash CHAR(40)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS articles_categories (
-            article_id VARCHAR(128), category_id VARCHAR(128),
-            FOREIGN KEY(article_id) REFERENCES articles(page_id)
-            ON DELETE CASCADE,
-            FOREIGN KEY(category_id) REFERENCES categories(id)
-            ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            article_id VARCHAR(128), category_id VARCHAR(128))
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS snippets (id VARCHAR(128) PRIMARY KEY,
-            snippet VARCHAR(%s), section VARCHAR(768), article_id VARCHAR(128),
-            FOREIGN KEY(article_id) REFERENCES articles(page_id)
-            ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            snippet VARCHAR(%s), section VARCHAR(768), article_id VARCHAR(128))
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''', (cfg.snippet_max_size * 2,))
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS snippets_links (prev VARCHAR(128),
-            next VARCHAR(128), cat_id VARCHAR(128),
-            FOREIGN KEY(prev) REFERENCES snippets(id) ON DELETE CASCADE,
-            FOREIGN KEY(next) REFERENCES snippets(id) ON DELETE CASCADE,
-            FOREIGN KEY(cat_id) REFERENCES categories(id) ON DELETE CASCADE)
+            next VARCHAR(128), cat_id VARCHAR(128))
             ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
         ''')
+        # Snippets in each category (and, under the id "all", every snippet)
+        # numbered sequentially from 0, for picking snippets at random
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS snippets_positions (
+            cat_id VARCHAR(128), pos INTEGER, snippet_id VARCHAR(128),
+            PRIMARY KEY (cat_id, pos)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+        # Incremented every time a new database is installed
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY,
+            installed DATETIME) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        ''')
+    if foreign_keys:
+        create_foreign_keys(db)
@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 import chstrings
 
 import os
+import re
 
 global_config = dict(
     # Approximate maximum length for a snippet
@@ -154,11 +155,47 @@ class Config(object):
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
+    # Configs are shared by all callers of get_localized_config, so make sure
+    # none of them changes it under the others' feet.
+    def __setattr__(self, name, value):
+        raise AttributeError('Config objects are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Config objects are immutable')
+
+def normalize_template_name(name):
+    # The first letter of template names is case-insensitive, see
+    # mwparserfromhell.wikicode.Wikicode.matches
+    return name[:1].upper() + name[1:]
+
+def _make_localized_config(lang_code):
+    settings = dict(global_config, **lang_code_to_config[lang_code])
+    for name, value in settings.items():
+        if isinstance(value, list):
+            settings[name] = tuple(value)
+
+    # Settings derived from the ones above, precomputed for the parsers
+    settings['citation_needed_templates_normalized'] = frozenset(
+        normalize_template_name(name)
+        for name in settings['citation_needed_templates'])
+    settings['category_name_blacklist_regexp'] = re.compile('|'.join(
+        '(?:%s)' % regexp
+        for regexp in settings['category_name_regexps_blacklist']) or
+        '(?!)') # an empty pattern would match every name
+
+    settings.update(
+        lang_code = lang_code, lang_code_to_config = lang_code_to_config)
+    settings['strings'] = chstrings.get_localized_strings(
+        Config(**settings), lang_code)
+    return Config(**settings)
+
+_localized_configs = {}
+
 def get_localized_config(lang_code = None):
     if lang_code is None:
         lang_code = os.getenv('CH_LANG')
-    cfg = Config(lang_code = lang_code,
-        **dict(global_config, **lang_code_to_config[lang_code]))
-    cfg.strings = chstrings.get_localized_strings(cfg, lang_code)
-    cfg.lang_code_to_config = lang_code_to_config
+    cfg = _localized_configs.get(lang_code)
+    if cfg is None:
+        cfg = _localized_configs[lang_code] = \
+            _make_localized_config(lang_code)
     return cfg
@@ -0,0 +1,41 @@
+import collections
+import json
+import os.path as op
+import re
+import threading
+
+CRAWLER_USER_AGENTS_JSON = op.join(op.dirname(op.realpath(__file__)),
+    'handlers', 'crawler-user-agents', 'crawler-user-agents.json')
+
+class CrawlerClassifier(object):
+    '''
+    Tells whether a user agent belongs to a crawler, according to the
+    patterns in crawler-user-agents/crawler-user-agents.json.
+
+    The patterns are compiled into a single regular expression, and the
+    results for the cache_size most recently seen user agents are cached.
+    '''
+
+    def __init__(self, cache_size = 4096):
+        crawler_user_agents = json.load(file(CRAWLER_USER_AGENTS_JSON))
+        # These patterns used to be matched with MySQL's REGEXP, which is
+        # case-insensitive.
+        self._regexp = re.compile('|'.join(
+            '(?:%s)' % obj['pattern'] for obj in crawler_user_agents),
+            re.IGNORECASE)
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def is_crawler(self, user_agent):
+        with self._lock:
+            try:
+                result = self._cache.pop(user_agent)
+            except KeyError:
+                result = self._regexp.search(user_agent) is not None
+            self._cache[user_agent] = result
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last = False)
+        return result
+
+crawler_classifier = CrawlerClassifier()
@@ -6,5 +6,7 @@ if _upper_dir not in sys.path:
     sys.path.append(_upper_dir)
 
 from common import *
+from snapshot import *
 from citationhunt import *
 from stats import *
+from requestlog import *
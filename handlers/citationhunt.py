@@ -1,10 +1,11 @@
 import chdb
 import config
 from common import *
+from snapshot import get_snapshot
 
 from snippet_parser import CITATION_NEEDED_MARKER, REF_MARKER
 
-import collections
+import random
 
 # the markup we're going to use for [citation needed] and <ref> tags,
 # pre-marked as safe for jinja.
@@ -12,10 +13,12 @@ SUPERSCRIPT_HTML = '<sup class="superscript">[%s]</sup>'
 SUPERSCRIPT_MARKUP = flask.Markup(SUPERSCRIPT_HTML)
 CITATION_NEEDED_MARKUP = flask.Markup(SUPERSCRIPT_HTML)
 
-Category = collections.namedtuple('Category', ['id', 'title'])
-CATEGORY_ALL = Category('all', '')
 def get_categories(lang_code, include_default = True):
-    categories = getattr(flask.g, '_categories', None)
+    snapshot = get_snapshot(lang_code)
+    if snapshot is not None:
+        categories = snapshot.categories
+    else:
+        categories = getattr(flask.g, '_categories', None)
     if categories is None:
         cursor = get_db(lang_code).cursor()
         cursor.execute('''
@@ -27,12 +30,19 @@ def get_categories(lang_code, include_default = True):
     return categories if include_default else categories[1:]
 
 def get_category_by_id(lang_code, catid, default = None):
+    snapshot = get_snapshot(lang_code)
+    if snapshot is not None:
+        return snapshot.categories_by_id.get(catid, default)
     for c in get_categories(lang_code):
         if catid == c.id:
             return c
     return default
 
 def select_snippet_by_id(lang_code, id):
+    snapshot = get_snapshot(lang_code)
+    if snapshot is not None:
+        return snapshot.snippets.get(id)
+
     cursor = get_db(lang_code).cursor()
     with log_time('select snippet by id'):
         cursor.execute('''
@@ -43,37 +53,52 @@ def select_snippet_by_id(lang_code, id):
     return ret
 
 def select_random_id(lang_code, cat = CATEGORY_ALL):
+    '''
+    Return the id of a random snippet in cat, or in any category if cat is
+    empty, or None if there are no snippets at all.
+    '''
+
+    snapshot = get_snapshot(lang_code)
+    if snapshot is not None:
+        ids = snapshot.positions.get(cat.id)
+        if not ids and cat is not CATEGORY_ALL:
+            ids = snapshot.positions.get(CATEGORY_ALL.id)
+        return random.choice(ids) if ids else None
+
     cursor = get_db(lang_code).cursor()
 
-    ret = None
-    if cat is not CATEGORY_ALL:
-        with log_time('select with category'):
+    # The snippets in each category are numbered sequentially from 0 in
+    # snippets_positions, so we can pick a random position and look it up.
+    with log_time('select random id'):
+        # install_new_database.py may swap the tables between the two
+        # queries, in which case the position may be gone, so try again
+        for attempt in range(2):
             cursor.execute('''
-                SELECT snippets.id FROM snippets, articles_categories
-                WHERE snippets.article_id = articles_categories.article_id AND
-                articles_categories.category_id = %s ORDER BY RAND()
-                LIMIT 1;''', (cat.id,))
-            ret = cursor.fetchone()
+                SELECT MAX(pos) FROM snippets_positions WHERE cat_id = %s;''',
+                (cat.id,))
+            max_pos = cursor.fetchone()[0]
+            if max_pos is None:
+                if cat is not CATEGORY_ALL:
+                    return select_random_id(lang_code, CATEGORY_ALL)
+                # the database is empty, maybe it was just reset
+                return None
 
-    if ret is None:
-        # Try to pick one id at random. For small datasets, the probability
-        # of getting an empty set in a query is non-negligible, so retry a
-        # few times as needed.
-        p = '1e-4' if not flask.current_app.debug else '1e-2'
-        with log_time('select without category'):
-            for retry in range(10):
-                cursor.execute(
-                    'SELECT id FROM snippets WHERE RAND() < %s LIMIT 1;', (p,))
-                ret = cursor.fetchone()
-                if ret: break
-
-    assert ret and len(ret) == 1
-    return ret[0]
+            cursor.execute('''
+                SELECT snippet_id FROM snippets_positions WHERE cat_id = %s AND
+                pos = %s;''', (cat.id, random.randint(0, max_pos)))
+            ret = cursor.fetchone()
+            if ret is not None:
+                return ret[0]
+    return None
 
 def select_next_id(lang_code, curr_id, cat = CATEGORY_ALL):
-    cursor = get_db(lang_code).cursor()
-
     if cat is not CATEGORY_ALL:
+        snapshot = get_snapshot(lang_code)
+        if snapshot is not None:
+            # None if curr_id doesn't belong to the category
+            return snapshot.next_ids.get(cat.id, {}).get(curr_id)
+
+        cursor = get_db(lang_code).cursor()
         with log_time('select next id'):
             cursor.execute('''
                 SELECT next FROM snippets_links WHERE prev = %s
@@ -87,7 +112,11 @@ def select_next_id(lang_code, curr_id, cat = CATEGORY_ALL):
     else:
         next_id = curr_id
         for i in range(3): # super paranoid :)
-            next_id = select_random_id(lang_code, cat)
+            random_id = select_random_id(lang_code, cat)
+            if random_id is None:
+                # no snippets to pick from, stay on this one
+                break
+            next_id = random_id
             if next_id != curr_id:
                 break
     return next_id
@@ -144,6 +173,9 @@ def citation_hunt(lang_code):
             category_filter_autofocus = autofocus)
 
     id = select_random_id(lang_code, cat)
+    if id is None:
+        # there are no snippets to show, e.g. during a database update
+        flask.abort(503)
     return flask.redirect(
         flask.url_for('citation_hunt',
             id = id, cat = cat.id, lang_code = lang_code))
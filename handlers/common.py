@@ -3,15 +3,20 @@ import config
 
 import flask
 
+import collections
 import contextlib
 from datetime import datetime
 import functools
 
+Category = collections.namedtuple('Category', ['id', 'title'])
+CATEGORY_ALL = Category('all', '')
+
 def get_db(lang_code):
     localized_dbs = getattr(flask.g, '_localized_dbs', {})
     db = localized_dbs.get(lang_code, None)
     if db is None:
-        db = localized_dbs[lang_code] = chdb.init_db(lang_code)
+        db = localized_dbs[lang_code] = \
+            chdb.get_db_pool(lang_code).acquire()
     flask.g._localized_dbs = localized_dbs
     return db
 
@@ -26,9 +31,20 @@ def log_time(operation):
 def get_stats_db():
     db = getattr(flask.g, '_stats_db', None)
     if db is None:
-        db = flask.g._stats_db = chdb.init_stats_db()
+        db = flask.g._stats_db = chdb.get_stats_db_pool().acquire()
     return db
 
+def release_dbs():
+    '''Return the connections used in this context to their pools.'''
+    for lang_code, db in getattr(flask.g, '_localized_dbs', {}).items():
+        chdb.get_db_pool(lang_code).release(db)
+    flask.g._localized_dbs = {}
+
+    db = getattr(flask.g, '_stats_db', None)
+    if db is not None:
+        chdb.get_stats_db_pool().release(db)
+        flask.g._stats_db = None
+
 def validate_lang_code(handler):
     @functools.wraps(handler)
     def wrapper(lang_code = '', *args, **kwds):
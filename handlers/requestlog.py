@@ -0,0 +1,112 @@
+import chdb
+from crawlers import crawler_classifier
+
+import Queue
+import atexit
+import os
+import threading
+import time
+import traceback
+
+class RequestLogger(object):
+    '''
+    Buffers rows in memory and hands them to write_rows from a background
+    thread, so that whoever logs them doesn't wait on the database.
+
+    write_rows gets called with lists of at most batch_size rows, and rows
+    wait at most flush_interval_ms milliseconds before being written. Up to
+    max_buffered rows are kept in memory; rows logged when the buffer is full
+    are dropped, and so are rows that write_rows fails to write. Either way,
+    they get counted in the `dropped` attribute.
+    '''
+
+    def __init__(self, write_rows, max_buffered = 10000, batch_size = 100,
+            flush_interval_ms = 1000):
+        self.dropped = 0
+        self._write_rows = write_rows
+        self._max_buffered = max_buffered
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval_ms / 1000.
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def log(self, row):
+        self._ensure_flusher()
+        try:
+            self._queue.put_nowait(row)
+        except Queue.Full:
+            self._count_dropped(1)
+
+    def flush(self):
+        '''Synchronously write all rows currently in the buffer.'''
+        if self._queue is None:
+            return
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        for i in range(0, len(rows), self._batch_size):
+            self._write(rows[i:i+self._batch_size])
+
+    def _count_dropped(self, n):
+        with self._lock:
+            self.dropped += n
+
+    def _ensure_flusher(self):
+        # Threads don't survive a fork, so make sure the flusher runs in
+        # whatever process we're in now (e.g., a freshly forked uwsgi worker).
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self._max_buffered)
+            flusher = threading.Thread(target = self._flush_loop)
+            flusher.daemon = True
+            flusher.start()
+            atexit.register(self.flush)
+            self._pid = os.getpid()
+
+    def _flush_loop(self):
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.time() + self._flush_interval
+            while len(rows) < self._batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout = timeout))
+                except Queue.Empty:
+                    break
+            self._write(rows)
+
+    def _write(self, rows):
+        try:
+            self._write_rows(rows)
+        except Exception:
+            traceback.print_exc()
+            self._count_dropped(len(rows))
+
+def write_requests(rows):
+    # the user agent is the 7th column, see app.log_request
+    rows = [row + (crawler_classifier.is_crawler(row[6]),) for row in rows]
+    pool = chdb.get_stats_db_pool()
+    db = pool.acquire()
+    try:
+        def insert(cursor):
+            # executemany turns this into a single multi-row INSERT
+            with chdb.ignore_warnings():
+                cursor.executemany('''
+                    INSERT INTO requests (ts, lang_code, snippet_id,
+                    category_id, url, prefetch, user_agent, status_code,
+                    referrer, is_crawler) VALUES
+                    (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''', rows)
+        db.execute_with_retry(insert)
+    finally:
+        pool.release(db)
+
+request_logger = RequestLogger(write_requests)
@@ -0,0 +1,114 @@
+from common import *
+
+import flask
+
+import threading
+import time
+
+# How often to check whether a new database has been installed
+GENERATION_CHECK_INTERVAL_SECONDS = 60
+
+class Snapshot(object):
+    '''
+    An in-memory copy of everything the citation_hunt handler needs from the
+    database of one language, as of a given generation.
+    '''
+
+    def __init__(self, generation, cursor):
+        self.generation = generation
+
+        cursor.execute('''
+            SELECT id, title FROM categories WHERE id != "unassigned"
+            ORDER BY title;''')
+        self.categories = [CATEGORY_ALL] + [Category(*row) for row in cursor]
+        self.categories_by_id = {c.id: c for c in self.categories}
+
+        # id -> (snippet, section, article url, article title)
+        cursor.execute('''
+            SELECT snippets.id, snippets.snippet, snippets.section,
+            articles.url, articles.title FROM snippets, articles
+            WHERE snippets.article_id = articles.page_id;''')
+        self.snippets = {row[0]: row[1:] for row in cursor}
+
+        # category id -> {snippet id -> next snippet id}
+        self.next_ids = {}
+        cursor.execute('SELECT prev, next, cat_id FROM snippets_links;')
+        for prev, next, cat_id in cursor:
+            self.next_ids.setdefault(cat_id, {})[prev] = next
+
+        # category id -> [snippet ids]
+        self.positions = {}
+        cursor.execute('''
+            SELECT cat_id, snippet_id FROM snippets_positions
+            ORDER BY cat_id, pos;''')
+        for cat_id, snippet_id in cursor:
+            self.positions.setdefault(cat_id, []).append(snippet_id)
+
+def load_generation(cursor):
+    cursor.execute('SELECT MAX(id) FROM generation;')
+    return cursor.fetchone()[0]
+
+class SnapshotCache(object):
+    '''
+    Holds one Snapshot per language, reloading it when install_scratch_db
+    bumps the generation in the database. The generation is checked at most
+    once every GENERATION_CHECK_INTERVAL_SECONDS, so requests in between
+    don't touch the database at all.
+
+    Each language is reloaded by a single thread at a time, under a lock of
+    its own, while other requests keep getting the previous snapshot.
+    '''
+
+    def __init__(self):
+        self._locks_lock = threading.Lock()
+        self._locks = {}
+        # lang_code -> (snapshot, time of the next generation check), stored
+        # together so they're always read consistently without a lock
+        self._entries = {}
+
+    def _get_lock(self, lang_code):
+        with self._locks_lock:
+            return self._locks.setdefault(lang_code, threading.Lock())
+
+    def get(self, lang_code):
+        entry = self._entries.get(lang_code)
+        if entry is not None and time.time() < entry[1]:
+            return entry[0]
+
+        lock = self._get_lock(lang_code)
+        if entry is None:
+            # nothing to serve until the first load is done
+            lock.acquire()
+        elif not lock.acquire(False):
+            # another thread is checking or reloading, serve the old one
+            return entry[0]
+        try:
+            entry = self._entries.get(lang_code)
+            if entry is not None and time.time() < entry[1]:
+                return entry[0]
+
+            snapshot = entry[0] if entry is not None else None
+            cursor = get_db(lang_code).cursor()
+            generation = load_generation(cursor)
+            while snapshot is None or snapshot.generation != generation:
+                with log_time('load snapshot'):
+                    snapshot = Snapshot(generation, cursor)
+                # make sure the tables weren't swapped while we loaded them
+                generation = load_generation(cursor)
+            self._entries[lang_code] = (snapshot,
+                time.time() + GENERATION_CHECK_INTERVAL_SECONDS)
+            return snapshot
+        finally:
+            lock.release()
+
+_snapshot_cache = SnapshotCache()
+
+def get_snapshot(lang_code):
+    '''
+    Return the Snapshot for lang_code, or None if the SNAPSHOT_CACHE option
+    is disabled, in which case the database should be queried directly.
+    '''
+
+    if not flask.current_app.config.get('SNAPSHOT_CACHE'):
+        return None
+    return _snapshot_cache.get(lang_code)
@@ -3,12 +3,19 @@
 '''
 Assign categories to the pages in the CitationHunt database.
 
+The categories of each page are loaded from the Wikipedia replica, unless a
+file saved by load_categories.py is given.
+
 Usage:
     assign_categories.py [--max-categories=<n>] [--mysql-config=<FILE>]
+        [--compact] [--categories-file=<FILE>]
 
 Options:
-    --max-categories=<n>   Maximum number of categories to use [default: inf].
-    --mysql-config=<FILE>  MySQL config file [default: ./ch.my.cnf].
+    --max-categories=<n>     Maximum number of categories to use [default: inf].
+    --mysql-config=<FILE>    MySQL config file [default: ./ch.my.cnf].
+    --compact                Use less memory for the pages in each
+                             category, at the cost of some speed.
+    --categories-file=<FILE> File saved by load_categories.py.
 '''
 
 from __future__ import unicode_literals
@@ -22,11 +29,18 @@ from utils import *
 
 import docopt
 
-import re
+import array
 import collections
+import heapq
+import itertools
+import operator
+import pickle
 
 log = Logger()
 
+# How many rows to write with each multi-row INSERT
+ROWS_PER_INSERT = 1000
+
 class CategoryName(unicode):
     '''
     The canonical format for categories, which is the one we'll use
@@ -54,9 +68,10 @@ class CategoryName(unicode):
 
 def category_ids_to_names(wpcursor, category_ids):
     category_names = set()
-    for pageid in category_ids:
-        wpcursor.execute('''SELECT page_title FROM page WHERE page_id = %s''',
-            (pageid,))
+    for chunk in chunks(list(category_ids), PAGES_PER_QUERY):
+        wpcursor.execute('''
+            SELECT page_title FROM page WHERE page_id IN (%s)''' %
+            ', '.join(['%s'] * len(chunk)), chunk)
         category_names.update(
             CategoryName.from_wp_page(row[0])
             for row in wpcursor)
@@ -78,81 +93,244 @@ def load_hidden_categories(wpcursor):
     hidden_page_ids = [row[0] for row in wpcursor]
     return category_ids_to_names(wpcursor, hidden_page_ids)
 
-def load_categories_for_page(wpcursor, pageid):
-    wpcursor.execute('''
-        SELECT cl_to FROM categorylinks WHERE cl_from = %s''', (pageid,))
-    return set(CategoryName.from_wp_categorylinks(row[0]) for row in wpcursor)
+def load_categories_for_pages(wpcursor, pageids):
+    '''
+    Yields a (pageid, set of category names) tuple for each of pageids,
+    loading the categories of PAGES_PER_QUERY pages per query.
+    '''
+
+    for chunk in chunks(list(pageids), PAGES_PER_QUERY):
+        # cl_from is an integer, our pageids are strings
+        pageids_by_int = {int(pageid): pageid for pageid in chunk}
+        categories = {pageid: set() for pageid in chunk}
+        wpcursor.execute('''
+            SELECT cl_from, cl_to FROM categorylinks WHERE cl_from IN (%s)''' %
+            ', '.join(['%s'] * len(chunk)), pageids_by_int.keys())
+        for cl_from, cl_to in wpcursor:
+            categories[pageids_by_int[cl_from]].add(
+                CategoryName.from_wp_categorylinks(cl_to))
+        for pageid in chunk:
+            yield pageid, categories[pageid]
+
+def load_usable_categories(wpcursor, pageids):
+    '''
+    Yields a (pageid, list of category names) tuple for each of pageids,
+    leaving out the categories that can't be used in CitationHunt.
+    '''
+
+    hidden_categories = load_hidden_categories(wpcursor)
+    log.info('loaded %d hidden categories (%s...)' % \
+        (len(hidden_categories), next(iter(hidden_categories))))
+
+    for n, (pageid, catnames) in enumerate(
+        load_categories_for_pages(wpcursor, pageids)):
+        yield pageid, [catname for catname in catnames
+            if category_is_usable(catname, hidden_categories)]
+        log.progress('loaded categories for %d pageids' % (n + 1))
+
+class PageSets(object):
+    '''
+    The pages in each category, along with which of them are yet to be
+    covered by choose_categories. This is what choose_categories works with,
+    and here pages are kept as sets of pageids.
+    '''
+
+    def __init__(self):
+        self._categories_to_ids = collections.defaultdict(set)
+        self._uncovered = set()
+
+    def add(self, pageid, catnames):
+        for catname in catnames:
+            self._categories_to_ids[catname].add(pageid)
+        self._uncovered.add(pageid)
+
+    def categories(self):
+        return self._categories_to_ids.keys()
+
+    def size(self, catname):
+        return len(self._categories_to_ids[catname])
+
+    def count_uncovered(self, catname):
+        return len(self._categories_to_ids[catname] & self._uncovered)
+
+    def count_all_uncovered(self):
+        return len(self._uncovered)
+
+    def cover(self, catname):
+        self._uncovered -= self._categories_to_ids[catname]
+
+    def pageids(self, catname):
+        return frozenset(self._categories_to_ids[catname])
+
+class CompactPageSets(PageSets):
+    '''
+    Like PageSets, but using a lot less memory: pageids are mapped to dense
+    integers, the pages in each category are an array of them, and the
+    uncovered pages are flagged in a bytearray indexed by them.
+
+    This trades speed for memory. Counting and covering the pages of a
+    category walks its array in Python, one page at a time, so
+    choose_categories is slower than with PageSets: on data the size of the
+    English Wikipedia, benchmark_choose_categories.py has it taking about 40%
+    longer, in less than half the memory. That's why PageSets is used unless
+    --compact is given.
+    '''
+
+    def __init__(self):
+        self._pageids = [] # dense id -> pageid
+        self._categories_to_ids = collections.defaultdict(
+            lambda: array.array(b'i'))
+        self._uncovered = bytearray()
+        self._nuncovered = 0
+
+    def add(self, pageid, catnames):
+        id = len(self._pageids)
+        self._pageids.append(pageid)
+        for catname in catnames:
+            self._categories_to_ids[catname].append(id)
+        self._uncovered.append(1)
+        self._nuncovered += 1
+
+    def count_uncovered(self, catname):
+        return sum(itertools.imap(
+            self._uncovered.__getitem__, self._categories_to_ids[catname]))
+
+    def count_all_uncovered(self):
+        return self._nuncovered
+
+    def cover(self, catname):
+        for id in self._categories_to_ids[catname]:
+            if self._uncovered[id]:
+                self._uncovered[id] = 0
+                self._nuncovered -= 1
+
+    def pageids(self, catname):
+        return frozenset(
+            self._pageids[id] for id in self._categories_to_ids[catname])
 
 def category_is_usable(catname, hidden_categories):
     assert isinstance(catname, CategoryName)
     if catname in hidden_categories:
         return False
     cfg = config.get_localized_config()
-    for regexp in cfg.category_name_regexps_blacklist:
-        if re.search(regexp, catname):
-            return False
-    return True
+    return not cfg.category_name_blacklist_regexp.search(catname)
+
+def choose_categories(page_sets, max_categories):
+    '''
+    Greedily pick the categories that cover the most unsourced pages, relative
+    to how far their size is from the ideal, until all pages in page_sets
+    are covered or we have max_categories. Ties are broken by category name.
+    Returns a set of (category name, frozenset of pageids) tuples.
+
+    A category's score can only go down as more pages get covered, so instead
+    of recomputing every score after each pick, we keep the categories in a
+    heap keyed by their last known score, and only recompute the score of the
+    category on top. If it's still the same, no other category can beat it.
+    '''
 
-def choose_categories(categories_to_ids, unsourced_pageids, max_categories):
     categories = set()
-    category_sets = categories_to_ids.items()
-    total = float(len(unsourced_pageids))
+    total = float(page_sets.count_all_uncovered())
 
     desired_pages_per_category = 20
     category_costs = {
-        catname: abs(len(pageids) - desired_pages_per_category) + 1.0
-        for catname, pageids in category_sets
+        catname: abs(page_sets.size(catname) - desired_pages_per_category) + 1.0
+        for catname in page_sets.categories()
     }
 
-    def key_fn(cs):
-        catname, pageids = cs
-        return len(pageids & unsourced_pageids) / category_costs[catname]
+    def score(catname):
+        return page_sets.count_uncovered(catname) / category_costs[catname]
+
+    heap = [(-score(catname), catname) for catname in page_sets.categories()]
+    heapq.heapify(heap)
+    while heap and page_sets.count_all_uncovered() and \
+        len(categories) < max_categories:
+        neg_score, catname = heapq.heappop(heap)
+        current_score = score(catname)
+        if current_score != -neg_score:
+            heapq.heappush(heap, (-current_score, catname))
+            continue
 
-    while unsourced_pageids and len(categories) < max_categories:
-        category_sets.sort(key = key_fn)
-        catname, covered_pageids = category_sets.pop()
-        categories.add((catname, frozenset(covered_pageids)))
-        unsourced_pageids -= covered_pageids
+        categories.add((catname, page_sets.pageids(catname)))
+        page_sets.cover(catname)
 
-        rem = len(unsourced_pageids)
+        rem = page_sets.count_all_uncovered()
         log.progress('%d uncategorized pages (%d %%)' % \
             (rem, (rem / total) * 100))
     log.info('finished with %d categories' % len(categories))
     return categories
 
-def build_snippets_links_for_category(cursor, category_id):
+def insert_rows(cursor, statement, rows):
+    for chunk in chunks(rows, ROWS_PER_INSERT):
+        # executemany turns this into a single multi-row INSERT
+        cursor.executemany(statement, chunk)
+
+def build_snippets_links_and_positions(cursor):
+    '''
+    Build the snippets_links ring and the snippets_positions of every category
+    in a single pass over the snippets in articles_categories, ordered by
+    category and then by article title.
+    '''
+
     cursor.execute('''
-        SELECT snippets.id FROM snippets, articles_categories, articles
+        SELECT articles_categories.category_id, snippets.id
+        FROM snippets, articles_categories, articles
         WHERE snippets.article_id = articles_categories.article_id AND
-        articles.page_id = articles_categories.article_id AND
-        articles_categories.category_id = %s ORDER BY articles.title;''',
-        (category_id,))
-    snippets = [r[0] for r in cursor]
-
-    prev = snippets[0]
-    for s in snippets[1:] + [snippets[0]]:
-        cursor.execute('''
-            INSERT INTO snippets_links VALUES (%s, %s, %s)
-        ''', (prev, s, category_id))
-        prev = s
+        articles.page_id = articles_categories.article_id
+        ORDER BY articles_categories.category_id, articles.title,
+        snippets.id;''')
+    rows = cursor.fetchall()
+
+    links = []
+    positions = []
+    def flush(force = False):
+        if links and (force or len(links) >= ROWS_PER_INSERT):
+            insert_rows(cursor, '''
+                INSERT INTO snippets_links VALUES (%s, %s, %s)
+            ''', links)
+            del links[:]
+        if positions and (force or len(positions) >= ROWS_PER_INSERT):
+            insert_rows(cursor, '''
+                INSERT INTO snippets_positions VALUES (%s, %s, %s)
+            ''', positions)
+            del positions[:]
+
+    for category_id, group in itertools.groupby(
+        rows, key = operator.itemgetter(0)):
+        snippets = [snippet_id for _, snippet_id in group]
+        # the last snippet links back to the first one
+        links.extend((prev, next, category_id) for prev, next in
+            zip(snippets, snippets[1:] + snippets[:1]))
+        positions.extend((category_id, pos, snippet_id)
+            for pos, snippet_id in enumerate(snippets))
+        flush()
+    flush(force = True)
+
+def build_snippets_positions_for_all(cursor):
+    # MAX(pos) + 1 must be the number of snippets, so only the density of the
+    # positions matters, not the order in which they get assigned.
+    cursor.execute('SET @pos := -1')
+    cursor.execute('''
+        INSERT INTO snippets_positions
+        SELECT "all", @pos := @pos + 1, id FROM snippets
+    ''')
 
 def update_citationhunt_db(chdb, categories):
-    for n, (catname, pageids) in enumerate(categories):
-        category_id = category_name_to_id(catname)
-        def insert(cursor):
-            cursor.execute('''
-                INSERT IGNORE INTO categories VALUES(%s, %s)
-            ''', (category_id, unicode(catname)))
-
-            prev = ''
-            for page_id in pageids:
-                cursor.execute('''
-                    INSERT INTO articles_categories VALUES (%s, %s)
-                ''', (page_id, category_id))
-            build_snippets_links_for_category(cursor, category_id)
-        chdb.execute_with_retry(insert)
-
-        log.progress('saved %d categories' % (n + 1))
+    categories = [(category_name_to_id(catname), catname, pageids)
+        for catname, pageids in categories]
+    def insert(cursor):
+        insert_rows(cursor, '''
+            INSERT IGNORE INTO categories VALUES(%s, %s)
+        ''', [(category_id, unicode(catname))
+            for category_id, catname, _ in categories])
+        log.info('saved %d categories' % len(categories))
+        insert_rows(cursor, '''
+            INSERT INTO articles_categories VALUES (%s, %s)
+        ''', [(page_id, category_id)
+            for category_id, _, pageids in categories
+            for page_id in pageids])
+        build_snippets_links_and_positions(cursor)
+    chdb.execute_with_retry(insert)
+    chdb.execute_with_retry(build_snippets_positions_for_all)
     log.info('all done.')
 
 def reset_chdb_tables(cursor):
@@ -162,44 +340,48 @@ def reset_chdb_tables(cursor):
     cursor.execute('DELETE FROM categories')
     log.info('resetting snippets_links table...')
     cursor.execute('DELETE FROM snippets_links')
+    log.info('resetting snippets_positions table...')
+    cursor.execute('DELETE FROM snippets_positions')
 
-def assign_categories(max_categories, mysql_default_cnf):
+def assign_categories(max_categories, mysql_default_cnf, compact,
+    categories_file = None):
     chdb = chdb_.init_scratch_db()
     chdb.execute_with_retry(reset_chdb_tables)
     unsourced_pageids = load_unsourced_pageids(chdb)
 
-    wpdb = chdb_.init_wp_replica_db()
-    wpcursor = wpdb.cursor()
-    assert wpcursor.execute('SELECT * FROM page LIMIT 1;') == 1
-    assert wpcursor.execute('SELECT * FROM categorylinks LIMIT 1;') == 1
-
-    hidden_categories = load_hidden_categories(wpcursor)
-    log.info('loaded %d hidden categories (%s...)' % \
-        (len(hidden_categories), next(iter(hidden_categories))))
-
-    categories_to_ids = collections.defaultdict(set)
+    wpdb = None
+    if categories_file is not None:
+        with open(categories_file, 'rb') as cf:
+            categories_by_pageid = pickle.load(cf)
+        log.info('loaded categories for %d pageids from %s' % (
+            len(categories_by_pageid), categories_file))
+        pages = ((pageid, categories_by_pageid.get(pageid, []))
+            for pageid in unsourced_pageids)
+    else:
+        wpdb = chdb_.init_wp_replica_db()
+        wpcursor = wpdb.cursor()
+        assert wpcursor.execute('SELECT * FROM page LIMIT 1;') == 1
+        assert wpcursor.execute('SELECT * FROM categorylinks LIMIT 1;') == 1
+        pages = load_usable_categories(wpcursor, unsourced_pageids)
+
+    page_sets = CompactPageSets() if compact else PageSets()
     page_ids_with_no_categories = 0
-    for n, pageid in enumerate(list(unsourced_pageids)):
-        page_has_at_least_one_category = False
-        for catname in load_categories_for_page(wpcursor, pageid):
-            if category_is_usable(catname, hidden_categories):
-                page_has_at_least_one_category = True
-                categories_to_ids[catname].add(pageid)
-        if not page_has_at_least_one_category:
-            unsourced_pageids.remove(pageid)
+    for pageid, catnames in pages:
+        if catnames:
+            page_sets.add(pageid, catnames)
+        else:
             page_ids_with_no_categories += 1
-        log.progress('loaded categories for %d pageids' % (n + 1))
 
     log.info('%d pages lack usable categories!' % page_ids_with_no_categories)
+    usable_categories = page_sets.categories()
     log.info('found %d usable categories (%s, %s...)' % \
-        (len(categories_to_ids), categories_to_ids.keys()[0],
-        categories_to_ids.keys()[1]))
+        (len(usable_categories), usable_categories[0], usable_categories[1]))
 
-    categories = choose_categories(categories_to_ids, unsourced_pageids,
-        max_categories)
+    categories = choose_categories(page_sets, max_categories)
 
     update_citationhunt_db(chdb, categories)
-    wpdb.close()
+    if wpdb is not None:
+        wpdb.close()
     chdb.close()
     return 0
 
@@ -207,5 +389,7 @@ if __name__ == '__main__':
     args = docopt.docopt(__doc__)
     max_categories = float(args['--max-categories'])
     mysql_default_cnf = args['--mysql-config']
-    ret = assign_categories(max_categories, mysql_default_cnf)
+    compact = args['--compact']
+    ret = assign_categories(max_categories, mysql_default_cnf, compact,
+        args['--categories-file'])
     sys.exit(ret)
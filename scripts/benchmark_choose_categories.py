@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+'''
+Benchmark assign_categories.choose_categories on synthetic data.
+
+The defaults approximate the English Wikipedia: a few hundred thousand
+unsourced pages, each in a handful of categories, whose sizes follow a
+power law. Both PageSets and CompactPageSets are benchmarked, each in its own
+process, reporting the time choose_categories takes and how much the peak
+resident memory grew while building the page sets and choosing. The latter
+trades speed for memory: it should use much less of it, but be somewhat
+slower. With the compare option, the result is also checked against a naive
+implementation that recomputes every score on each pick, which is much slower
+at this size.
+
+Memory is measured with /proc/self/statm and getrusage, so on Linux only.
+
+Usage:
+    benchmark_choose_categories.py [--pages=<n>] [--categories=<n>]
+        [--categories-per-page=<n>] [--max-categories=<n>] [--compare]
+
+Options:
+    --pages=<n>                Number of unsourced pages [default: 400000].
+    --categories=<n>           Number of categories [default: 300000].
+    --categories-per-page=<n>  Average categories per page [default: 5].
+    --max-categories=<n>       Maximum number of categories [default: 5500].
+    --compare                  Compare with the naive implementation.
+'''
+
+from __future__ import unicode_literals
+
+import sys
+sys.path.append('../')
+
+import assign_categories
+from utils import *
+
+import docopt
+
+import collections
+import multiprocessing
+import os
+import random
+import resource
+import time
+
+def make_categories(npages, ncategories, categories_per_page):
+    # Returns (pageid, category names) tuples, like load_categories_for_pages.
+    random.seed(0)
+    pages = []
+    for pageid in xrange(npages):
+        catnames = set()
+        for _ in xrange(random.randint(1, 2 * categories_per_page - 1)):
+            # a few categories are huge, most of them are tiny
+            category = int(ncategories * random.random() ** 3)
+            catnames.add('Category %d' % category)
+        pages.append((unicode(pageid), catnames))
+    return pages
+
+def choose_categories_naive(categories_to_ids, unsourced_pageids,
+    max_categories):
+    # Like choose_categories, but recomputing all scores for every pick.
+    categories = set()
+    remaining = set(categories_to_ids)
+
+    desired_pages_per_category = 20
+    category_costs = {
+        catname: abs(len(pageids) - desired_pages_per_category) + 1.0
+        for catname, pageids in categories_to_ids.iteritems()
+    }
+
+    def key_fn(catname):
+        pageids = categories_to_ids[catname]
+        score = len(pageids & unsourced_pageids) / category_costs[catname]
+        return (-score, catname)
+
+    while remaining and unsourced_pageids and len(categories) < max_categories:
+        catname = min(remaining, key = key_fn)
+        remaining.remove(catname)
+        covered_pageids = categories_to_ids[catname]
+        categories.add((catname, frozenset(covered_pageids)))
+        unsourced_pageids -= covered_pageids
+    return categories
+
+def current_rss_kb():
+    with open('/proc/self/statm') as statm:
+        rss_pages = int(statm.read().split()[1])
+    return rss_pages * os.sysconf(b'SC_PAGE_SIZE') / 1024
+
+def run_in_subprocess(benchmark_fn, arguments):
+    # Runs benchmark_fn on freshly generated pages in a new process, so each
+    # implementation's peak memory use is measured on its own. Returns its
+    # results, plus by how many KB the peak RSS exceeded the RSS right after
+    # generating the pages.
+    def run(q):
+        pages = make_categories(
+            int(arguments['--pages']), int(arguments['--categories']),
+            int(arguments['--categories-per-page']))
+        baseline_kb = current_rss_kb()
+        results = benchmark_fn(pages, int(arguments['--max-categories']))
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        q.put(results + (peak_kb - baseline_kb,))
+    q = multiprocessing.Queue()
+    p = multiprocessing.Process(target = run, args = (q,))
+    p.start()
+    results = q.get()
+    p.join()
+    return results
+
+def benchmark_naive(pages, max_categories):
+    categories_to_ids = collections.defaultdict(set)
+    for pageid, catnames in pages:
+        for catname in catnames:
+            categories_to_ids[catname].add(pageid)
+    unsourced_pageids = set(pageid for pageid, _ in pages)
+    start = time.time()
+    categories = choose_categories_naive(
+        categories_to_ids, unsourced_pageids, max_categories)
+    return categories, time.time() - start, len(unsourced_pageids)
+
+def benchmark(page_sets_class, pages, max_categories):
+    page_sets = page_sets_class()
+    for pageid, catnames in pages:
+        page_sets.add(pageid, catnames)
+    start = time.time()
+    categories = assign_categories.choose_categories(page_sets, max_categories)
+    return categories, time.time() - start, page_sets.count_all_uncovered()
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    pages = make_categories(
+        int(arguments['--pages']), int(arguments['--categories']),
+        int(arguments['--categories-per-page']))
+    print 'generated %d categories' % len(
+        set.union(*(catnames for _, catnames in pages)))
+    del pages
+
+    implementations = [
+        ('sets', lambda pages, max_categories: benchmark(
+            assign_categories.PageSets, pages, max_categories)),
+        ('compact', lambda pages, max_categories: benchmark(
+            assign_categories.CompactPageSets, pages, max_categories)),
+    ]
+    if arguments['--compare']:
+        implementations.append(('naive', benchmark_naive))
+    results = []
+    for name, benchmark_fn in implementations:
+        categories, elapsed, uncovered, peak_kb = run_in_subprocess(
+            benchmark_fn, arguments)
+        print ('%s: %.2fs, %.1f MB peak memory, %d categories, '
+            '%d pages left uncovered' % (name, elapsed, peak_kb / 1024.0,
+            len(categories), uncovered))
+        results.append(categories)
+    assert all(r == results[0] for r in results), 'the covers differ!'
+    print 'the covers are the same'
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+'''
+Benchmark WorkerPool.
+
+The first benchmark measures how many tasks per second go through a
+WorkerPool whose workers and receiver do nothing, for a few batch sizes.
+The second one measures how long it takes to go through tasks of skewed
+durations (most are short, a few are long) with each dispatch mode.
+
+Usage:
+    benchmark_workerpool.py [--tasks=<n>] [--task-size=<n>] [--workers=<n>]
+
+Options:
+    --tasks=<n>      Number of tasks to post [default: 200000].
+    --task-size=<n>  Size of each task, in bytes [default: 100].
+    --workers=<n>    Number of workers for the dispatch benchmark [default: 4].
+'''
+
+import workerpool
+
+import docopt
+
+import multiprocessing
+import random
+import time
+
+BATCH_SIZES = [1, 10, 100, 1000]
+
+# the dispatch benchmark posts SKEWED_TASKS tasks, most of which sleep for
+# SHORT_TASK_SECONDS, but one in LONG_TASK_FREQUENCY sleeps for
+# LONG_TASK_SECONDS.
+SKEWED_TASKS = 1000
+SHORT_TASK_SECONDS = 0.001
+LONG_TASK_SECONDS = 0.2
+LONG_TASK_FREQUENCY = 50
+
+class NullWorker(workerpool.Worker):
+    def setup(self):
+        pass
+
+    def work(self, task):
+        return len(task)
+
+    def done(self):
+        pass
+
+class SleepingWorker(workerpool.Worker):
+    def setup(self):
+        pass
+
+    def work(self, task):
+        time.sleep(task)
+        return task
+
+    def done(self):
+        pass
+
+class CountingReceiver(workerpool.Receiver):
+    def __init__(self, count):
+        self.count = count
+
+    def setup(self):
+        self.received = 0
+
+    def receive(self, result):
+        self.received += 1
+
+    def done(self):
+        self.count.value = self.received
+
+def run(worker, tasks, **kwargs):
+    count = multiprocessing.Value('i', 0)
+    start = time.time()
+    wp = workerpool.WorkerPool(worker, CountingReceiver(count), **kwargs)
+    for task in tasks:
+        wp.post(task)
+    wp.done()
+    elapsed = time.time() - start
+    assert count.value == len(tasks), (count.value, len(tasks))
+    return elapsed
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    ntasks = int(arguments['--tasks'])
+    nworkers = int(arguments['--workers'])
+
+    tasks = ['x' * int(arguments['--task-size'])] * ntasks
+    for batch_size in BATCH_SIZES:
+        elapsed = run(NullWorker(), tasks, batch_size = batch_size)
+        print 'batch size %4d: %8d tasks/s' % (batch_size, ntasks / elapsed)
+
+    random.seed(0)
+    tasks = [LONG_TASK_SECONDS if random.randrange(LONG_TASK_FREQUENCY) == 0
+        else SHORT_TASK_SECONDS for _ in range(SKEWED_TASKS)]
+    for dispatch in workerpool.WorkerPool.DISPATCH_MODES:
+        elapsed = run(SleepingWorker(), tasks,
+            dispatch = dispatch, nworkers = nworkers)
+        print 'dispatch %-11s: %.2fs (ideal %.2fs)' % (
+            dispatch, elapsed, sum(tasks) / nworkers)
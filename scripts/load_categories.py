@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+'''
+Load the usable categories of the pages in a pageid file from the Wikipedia
+replica, and save them for assign_categories.py.
+
+This only needs the list of pages, not the parsed dump, so it can run while
+parse_pages_articles.py is still parsing.
+
+Usage:
+    load_categories.py <pageid-file> <categories-file>
+'''
+
+from __future__ import unicode_literals
+
+import sys
+sys.path.append('../')
+
+import chdb
+from assign_categories import load_usable_categories
+from utils import *
+
+import docopt
+
+import itertools
+import os
+import pickle
+
+log = Logger()
+
+def load_categories(pageids, categories_file):
+    wpdb = chdb.init_wp_replica_db()
+    categories_by_pageid = dict(
+        load_usable_categories(wpdb.cursor(), pageids))
+    wpdb.close()
+
+    # write to a temporary file first, so assign_categories.py never sees a
+    # partial file
+    tmp_file = categories_file + '.tmp'
+    with open(tmp_file, 'wb') as cf:
+        pickle.dump(categories_by_pageid, cf, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, categories_file)
+    log.info('saved categories for %d pageids' % len(categories_by_pageid))
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    with open(arguments['<pageid-file>']) as pf:
+        pageids = set(itertools.imap(str.strip, pf))
+    load_categories(pageids, arguments['<categories-file>'])
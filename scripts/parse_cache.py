@@ -0,0 +1,103 @@
+'''
+An on-disk cache of the snippets extracted from each article.
+
+Most articles don't change between dumps, so rather than parsing them again,
+their snippets can be looked up by a hash of their wikitext. The hash also
+covers the language's config and snippet_parser.PARSER_VERSION, so results
+from a different config or parser are never used.
+
+Each result is stored in a file of its own, written to a temporary file and
+renamed into place, so several processes can use the same cache at once and
+a crash never leaves a partial result behind.
+'''
+
+from __future__ import unicode_literals
+
+import sys
+sys.path.append('../')
+
+import config
+import snippet_parser
+from utils import *
+
+import errno
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+def config_fingerprint(lang_code):
+    '''
+    A hash of the settings of lang_code, which may affect the snippets
+    extracted for it.
+    '''
+
+    settings = dict(config.global_config,
+        **config.lang_code_to_config[lang_code])
+    return hashlib.sha1(json.dumps(
+        settings, sort_keys = True, default = repr)).hexdigest()
+
+class ParseCache(object):
+    def __init__(self, directory, lang_code):
+        self._directory = directory
+        self._prefix = e('%s:%s:%d:' % (lang_code,
+            config_fingerprint(lang_code), snippet_parser.PARSER_VERSION))
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, wikitext):
+        return hashlib.sha1(self._prefix + e(wikitext)).hexdigest()
+
+    def _path(self, key):
+        # spread the files over a few directories, to keep them small
+        return os.path.join(self._directory, key[:2], key)
+
+    def get(self, key):
+        '''
+        Return the snippets cached under key, or None if there are none.
+        '''
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                snippets = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        # mark the entry as used, see prune
+        os.utime(path, None)
+        self.hits += 1
+        return snippets
+
+    def put(self, key, snippets):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        f = tempfile.NamedTemporaryFile(
+            dir = os.path.dirname(path), prefix = '.tmp', delete = False)
+        try:
+            with f:
+                pickle.dump(snippets, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(f.name, path)
+        except:
+            os.unlink(f.name)
+            raise
+
+    def prune(self, last_used_before):
+        '''
+        Delete the entries that haven't been read or written since the
+        timestamp last_used_before, returning how many were deleted.
+        '''
+
+        deleted = 0
+        for dirpath, _, filenames in os.walk(self._directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.getmtime(path) < last_used_before:
+                    os.unlink(path)
+                    deleted += 1
+        return deleted
@@ -6,10 +6,30 @@ Parser for the pages+articles XML dump for CitationHunt.
 Given a file with one pageid per line, this script will find unsourced
 snippets in the pages in the pageid file. It will store the pages containing
 valid snippets in the `articles` database table, and the snippets in the
-`snippets` table.
+`snippets` table. The other pages are stored in the
+`articles_without_snippets` table.
+
+If the dump is a multistream dump and its index is also given, only the
+streams containing pages in the pageid file are read, and they are
+decompressed and split into pages by several processes in parallel.
+
+If a parse cache directory is given, the snippets of each article are cached
+there, and articles whose wikitext was already parsed in a previous run are
+not parsed again. Entries not used by the current run are deleted at the end.
 
 Usage:
-    parse_pages_articles.py <pages-articles-xml.bz2> <pageid-file>
+    parse_pages_articles.py [--multistream-index=<index.txt.bz2>]
+        [--readers=<n>] [--writers=<n>] [--processes=<n>]
+        [--parse-cache=<dir>] [--stats-file=<file>]
+        <pages-articles-xml.bz2> <pageid-file>
+
+Options:
+    --multistream-index=<index.txt.bz2>  Index of the multistream dump.
+    --readers=<n>  Processes reading the multistream dump [default: 4].
+    --writers=<n>  Processes writing to the database [default: 2].
+    --processes=<n>  Processes parsing articles (one per CPU but one if unset).
+    --parse-cache=<dir>  Directory to cache parsed articles in.
+    --stats-file=<file>  Where to save statistics [default: stats.pkl].
 '''
 
 from __future__ import unicode_literals
@@ -20,6 +40,7 @@ sys.path.append('../')
 
 import chdb
 import config
+import parse_cache
 import snippet_parser
 import workerpool
 from utils import *
@@ -32,8 +53,15 @@ try:
 except ImportError:
     import xml.etree.ElementTree as ET
 
+import io
+import re
+import hashlib
 import signal
+import time
+import bz2
 import bz2file
+import multiprocessing
+import collections
 import pickle
 import itertools
 import urllib
@@ -44,8 +72,17 @@ WIKIPEDIA_WIKI_URL = WIKIPEDIA_BASE_URL + '/wiki/'
 
 NAMESPACE_ARTICLE = '0'
 
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Matches the <ns> and <id> elements at the beginning of each <page>. The
+# revision also has an <id>, but it comes later.
+PAGE_HEADER_REGEXP = re.compile(br'<ns>([^<]*)</ns>\s*<id>([^<]*)</id>')
+
 log = Logger()
 
+def text_hash(wikitext):
+    return hashlib.sha1(e(wikitext)).hexdigest()
+
 def section_name_to_anchor(section):
     # See Sanitizer::escapeId
     # https://doc.wikimedia.org/mediawiki-core/master/php/html/classSanitizer.html#ae091dfff62f13c9c1e0d2e503b0cab49
@@ -58,19 +95,33 @@ def section_name_to_anchor(section):
     return section
 
 class RowParser(workerpool.Worker):
+    def __init__(self, parse_cache_dir = None):
+        self.parse_cache_dir = parse_cache_dir
+
     def setup(self):
-        self.parser = snippet_parser.get_localized_snippet_parser()
+        self.parser = snippet_parser.create_snippet_parser(cfg)
+        self.cache = None
+        if self.parse_cache_dir is not None:
+            self.cache = parse_cache.ParseCache(
+                self.parse_cache_dir, cfg.lang_code)
 
     def work(self, task):
         kind, info = task
         assert kind == 'article'
 
-        pageid, title, wikitext = info
+        pageid, title, rev_id, wikitext = info
         url = WIKIPEDIA_WIKI_URL + title.replace(' ', '_')
 
         snippets_rows = []
-        snippets = self.parser.extract_snippets(
-            wikitext, cfg.snippet_min_size, cfg.snippet_max_size)
+        snippets = None
+        if self.cache is not None:
+            cache_key = self.cache.key(wikitext)
+            snippets = self.cache.get(cache_key)
+        if snippets is None:
+            snippets = self.parser.extract_snippets(
+                wikitext, cfg.snippet_min_size, cfg.snippet_max_size)
+            if self.cache is not None:
+                self.cache.put(cache_key, snippets)
         for sec, snips in snippets:
             sec = section_name_to_anchor(sec)
             for sni in snips:
@@ -78,98 +129,293 @@ class RowParser(workerpool.Worker):
                 row = (id, sni, sec, pageid)
                 snippets_rows.append(row)
 
-        if snippets_rows:
-            article_row = (pageid, url, title)
-            return (kind, {'article': article_row, 'snippets': snippets_rows})
-        return (kind, {})
+        article_row = (pageid, url, title, rev_id, text_hash(wikitext))
+        return (kind, {'article': article_row, 'snippets': snippets_rows})
 
     def done(self):
-        pass
+        if self.cache is not None:
+            log.info('parse cache: %d hits, %d misses' % (
+                self.cache.hits, self.cache.misses))
 
-# FIXME originally we needed only a single process writing to the database,
-# because sqlite3 sucks at multiprocessing. We can probably change that with
-# MySQL.
+# There can be several of these writing to the database in parallel, each
+# with its own connection. The database must have been reset beforehand.
 class DatabaseWriter(workerpool.Receiver):
+    # Rows are buffered and written this many snippets (or articles without
+    # snippets) at a time, in one transaction with a multi-row INSERT per
+    # table.
+    BULK_INSERT_SNIPPETS = 1000
+
     def __init__(self):
         self.chdb = None
 
     def setup(self):
-        self.chdb = chdb.reset_scratch_db()
+        self.chdb = chdb.init_scratch_db()
+        self.articles_rows = []
+        self.snippets_rows = []
+        self.articles_without_snippets_rows = []
 
     def receive(self, task):
         kind, rows = task
         assert kind == 'article'
-        self.write_article_rows(rows)
-
-    def write_article_rows(self, rows):
-        if not rows:
+        if rows['snippets']:
+            self.articles_rows.append(rows['article'])
+            self.snippets_rows.extend(rows['snippets'])
+        else:
+            pageid, _, _, rev_id, wikitext_hash = rows['article']
+            self.articles_without_snippets_rows.append(
+                (pageid, rev_id, wikitext_hash))
+        if len(self.snippets_rows) + len(self.articles_without_snippets_rows) \
+            >= self.BULK_INSERT_SNIPPETS:
+            self.write_rows()
+
+    def write_rows(self):
+        if not self.articles_rows and not self.articles_without_snippets_rows:
             return
 
         def insert(cursor):
-            cursor.execute('''
-                INSERT INTO articles VALUES(%s, %s, %s)''', rows['article'])
-            cursor.executemany('''
-                INSERT IGNORE INTO snippets VALUES(%s, %s, %s, %s)''',
-                rows['snippets'])
+            # executemany turns these into multi-row INSERTs
+            if self.articles_rows:
+                cursor.executemany('''
+                    INSERT INTO articles VALUES(%s, %s, %s, %s, %s)''',
+                    self.articles_rows)
+                cursor.executemany('''
+                    INSERT IGNORE INTO snippets VALUES(%s, %s, %s, %s)''',
+                    self.snippets_rows)
+            if self.articles_without_snippets_rows:
+                cursor.executemany('''
+                    INSERT INTO articles_without_snippets
+                    VALUES(%s, %s, %s)''', self.articles_without_snippets_rows)
         self.chdb.execute_with_retry(insert)
+        self.articles_rows = []
+        self.snippets_rows = []
+        self.articles_without_snippets_rows = []
 
     def done(self):
+        self.write_rows()
         self.chdb.close()
 
-def handle_article(wp, element, pageids, stats):
+def parse_page(element, pageids):
+    '''
+    Extract what we need from a <page> element if it's an article in
+    pageids, returning a (kind, id, info) tuple, or None otherwise. Kind is
+    one of 'article', 'redirect' or 'empty', and only articles have info, an
+    (id, title, revision id, text) tuple.
+    '''
+
     # elements are not pickelable, so we can't pass them to workers. extract
     # all the relevant information here and offload only the wikicode
     # parsing.
 
+    if element.find('ns').text != NAMESPACE_ARTICLE:
+        return None
+
     id = d(element.find('id').text)
     if id not in pageids:
-        return
-    pageids.remove(id)
+        return None
 
     if element.find('redirect') is not None:
-        stats['redirect'].append(id)
-        return
+        return ('redirect', id, None)
 
     title = d(element.find('title').text)
+    rev_id = int(element.find('revision/id').text)
     text = element.find('revision/text').text
     if text is None:
-        stats['empty'].append(id)
-        return
-    text = d(text)
-
-    wp.post(('article', (id, title, text)))
-    return
-
-def parse_xml_dump(pages_articles_xml_bz2, pageids):
+        return ('empty', id, None)
+    return ('article', id, (id, title, rev_id, d(text)))
+
+def iter_page_elements(dump, pageids):
+    '''
+    Split a dump, read from the file-like object dump, into <page> elements,
+    yielding None for each page that is not an article in pageids, and the
+    element for the others.
+
+    Only the beginning of each page is looked at before deciding whether to
+    parse it, so the text of the other pages is skipped without ever being
+    stored or parsed. Pages whose namespace and id can't be found that way
+    are always parsed.
+    '''
+
+    buf = b''
+    pos = 0 # where to look for the next tag in buf
+    page = None # where the current page starts in buf
+    wanted = None # whether to parse the current page, None if unknown yet
+    while True:
+        chunk = dump.read(READ_BUFFER_SIZE)
+        if not chunk:
+            break
+        # drop the data we're done with, keeping only the current page if
+        # we may need to parse it
+        keep = page if page is not None and wanted is not False else pos
+        buf = buf[keep:] + chunk
+        pos -= keep
+        if page is not None:
+            page -= keep
+
+        while True:
+            if page is None:
+                start = buf.find(b'<page>', pos)
+                if start < 0:
+                    pos = max(pos, len(buf) - len(b'<page>') + 1)
+                    break
+                page = pos = start
+                wanted = None
+
+            end = buf.find(b'</page>', pos)
+            if wanted is None:
+                match = PAGE_HEADER_REGEXP.search(buf, page)
+                if match is not None and (end < 0 or match.end() < end):
+                    ns, id = match.groups()
+                    wanted = ns == NAMESPACE_ARTICLE and id in pageids
+                elif end >= 0:
+                    wanted = True
+            if end < 0:
+                pos = max(pos, len(buf) - len(b'</page>') + 1)
+                break
+
+            end += len(b'</page>')
+            yield ET.fromstring(buf[page:end]) if wanted else None
+            page = None
+            pos = end
+
+def iter_xml_dump(pages_articles_xml_bz2, pageids):
+    '''
+    Read the pages in pageids from a dump. Yields a (npages, pages) tuple for
+    every page read, where pages is a list of the results of parse_page.
+    '''
+
+    dump = bz2file.BZ2File(pages_articles_xml_bz2)
+    for element in iter_page_elements(dump, pageids):
+        page = parse_page(element, pageids) if element is not None else None
+        yield (1, [page] if page is not None else [])
+
+def read_multistream_index(multistream_index_bz2, pageids):
+    '''
+    Read the index of a multistream dump, whose lines look like
+    <offset>:<pageid>:<title>. Returns the sorted offsets of all streams, and
+    the set of offsets of the streams containing pages in pageids.
+    '''
+
+    offsets = set()
+    wanted = set()
+    for line in bz2file.BZ2File(multistream_index_bz2):
+        offset, pageid, _ = line.split(b':', 2)
+        offset = int(offset)
+        offsets.add(offset)
+        if pageid in pageids:
+            wanted.add(offset)
+    return sorted(offsets), wanted
+
+def init_stream_reader(multistream_xml_bz2, pageids):
+    global reader_dump, reader_pageids
+    reader_dump = open(multistream_xml_bz2, 'rb')
+    reader_pageids = pageids
+
+def read_stream(byte_range):
+    # Runs in the reader processes, see iter_multistream_xml_dump.
+    start, end = byte_range
+    reader_dump.seek(start)
+    xml = bz2.decompress(reader_dump.read(end - start))
+    npages = 0
+    pages = []
+    for element in iter_page_elements(io.BytesIO(xml), reader_pageids):
+        npages += 1
+        if element is not None:
+            page = parse_page(element, reader_pageids)
+            if page is not None:
+                pages.append(page)
+    return (npages, pages)
+
+def iter_multistream_xml_dump(multistream_xml_bz2, multistream_index_bz2,
+    pageids, nreaders):
+    '''
+    Like iter_xml_dump, but for multistream dumps, whose bz2 streams can be
+    decompressed independently. Only the streams containing pages in pageids
+    are read, by a pool of nreaders processes, and each (npages, pages) tuple
+    covers a whole stream.
+    '''
+
+    offsets, wanted = read_multistream_index(multistream_index_bz2, pageids)
+    offsets.append(os.path.getsize(multistream_xml_bz2))
+    byte_ranges = [(start, end) for start, end in zip(offsets, offsets[1:])
+        if start in wanted]
+    log.info('reading %d of %d streams' % (len(byte_ranges), len(offsets) - 1))
+
+    pool = multiprocessing.Pool(nreaders,
+        init_stream_reader, (multistream_xml_bz2, pageids))
+    try:
+        # only read a few streams ahead of what we've yielded, so they don't
+        # pile up in memory when the workers fall behind.
+        pending = collections.deque()
+        for byte_range in byte_ranges:
+            pending.append(pool.apply_async(read_stream, (byte_range,)))
+            if len(pending) >= 2 * nreaders:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def partition_by_pageid(result):
+    kind, rows = result
+    return int(rows['article'][0])
+
+def parse_xml_dump(pages, pageids, nwriters, nparsers = None,
+    parse_cache_dir = None, stats_file = 'stats.pkl'):
     count = 0
     stats = {'redirect': [], 'empty': [], 'pageids': None}
-    iterparser = ET.iterparse(bz2file.BZ2File(pages_articles_xml_bz2))
+    start_time = time.time()
 
-    parser = RowParser()
+    # the foreign keys are only created after all rows are written
+    chdb.reset_scratch_db(foreign_keys = False).close()
+    parser = RowParser(parse_cache_dir)
     writer = DatabaseWriter()
-    wp = workerpool.WorkerPool(parser, writer)
-    for _, element in iterparser:
-        element.tag = element.tag[element.tag.rfind('}')+1:]
-        if element.tag == 'page':
-            ns = element.find('ns').text
-            if ns == NAMESPACE_ARTICLE:
-                handle_article(wp, element, pageids, stats)
-            count += 1
-            if count % 10 == 0:
-                log.progress('processed about %d pages' % count)
-            element.clear()
+    wp = workerpool.WorkerPool(parser, writer, batch_size = 10,
+        dispatch = 'shared', nworkers = nparsers, queue_size = 16,
+        nreceivers = nwriters, partition = partition_by_pageid)
+    for npages, parsed_pages in pages:
+        for kind, id, info in parsed_pages:
+            if id not in pageids:
+                continue
+            pageids.remove(id)
+            if kind == 'article':
+                wp.post(('article', info))
+            else:
+                stats[kind].append(id)
+        if count // 10 != (count + npages) // 10:
+            log.progress('processed about %d pages' % (count + npages))
+        count += npages
         if canceled:
             log.info('canceled, killing process pool...')
+            pages.close()
             wp.cancel()
             return
     wp.done()
     stats['pageids'] = pageids
 
+    if parse_cache_dir is not None:
+        # every article parsed in this run has used its entry since we
+        # started, so the ones that didn't are for articles that changed or
+        # no longer need citations.
+        log.info('pruning the parse cache...')
+        cache = parse_cache.ParseCache(parse_cache_dir, cfg.lang_code)
+        log.info('deleted %d entries' % cache.prune(start_time))
+
+    log.info('creating foreign keys...')
+    db = chdb.init_scratch_db()
+    chdb.create_foreign_keys(db)
+    db.close()
+
+    blocked_seconds = wp.blocked_seconds()
+    log.info('waited %.1fs for the parsers, and they waited %.1fs for the '
+        'database writers' % (blocked_seconds['tasks'],
+            blocked_seconds['results']))
+
     if len(pageids) > 0:
         log.info('%d pageids were not found' % len(stats['pageids']))
     log.info('%d pages were redirects' % len(stats['redirect']))
     log.info('%d pages were empty' % len(stats['empty']))
-    with open('stats.pkl', 'wb') as statsf:
+    with open(stats_file, 'wb') as statsf:
         pickle.dump(stats, statsf)
 
 if __name__ == '__main__':
@@ -185,7 +431,16 @@ if __name__ == '__main__':
     pageids_file = arguments['<pageid-file>']
     with open(pageids_file) as pf:
         pageids = set(itertools.imap(str.strip, pf))
-    parse_xml_dump(xml_dump_filename, pageids)
+    if arguments['--multistream-index'] is not None:
+        pages = iter_multistream_xml_dump(xml_dump_filename,
+            arguments['--multistream-index'], pageids,
+            int(arguments['--readers']))
+    else:
+        pages = iter_xml_dump(xml_dump_filename, pageids)
+    nparsers = arguments['--processes']
+    parse_xml_dump(pages, pageids, int(arguments['--writers']),
+        int(nparsers) if nparsers is not None else None,
+        arguments['--parse-cache'], arguments['--stats-file'])
     log.info('all done.')
     if canceled:
         os.kill(os.getpid(), signal.SIGINT)
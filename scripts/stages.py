@@ -0,0 +1,157 @@
+'''
+A scheduler for the stages of a database update.
+
+Each stage is a command to run, along with the stages it depends on. Stages
+start as soon as all of their dependencies have finished successfully, so
+stages that don't depend on each other run concurrently, within a budget of
+CPUs shared by all stages.
+'''
+
+from __future__ import unicode_literals
+
+import sys
+sys.path.append('../')
+
+from utils import *
+
+import os
+import subprocess
+import time
+
+# How often to check whether running stages have finished
+POLL_INTERVAL_SECONDS = 1
+
+log = Logger()
+
+class Stage(object):
+    def __init__(self, name, command, deps = (), stdout = None, env = None,
+        cpus = 1):
+        '''
+        command is a list of arguments for subprocess.Popen, and deps the
+        names of the stages that must finish before this one can start. If
+        stdout is given, it is the name of a file the output of the command is
+        written to. env holds variables to add to the command's environment,
+        and cpus is how many CPUs the command keeps busy.
+        '''
+
+        self.name = name
+        self.command = command
+        self.deps = tuple(deps)
+        self.stdout = stdout
+        self.env = dict(env or {})
+        self.cpus = cpus
+
+class StageFailed(Exception):
+    def __init__(self, failures, timings):
+        '''
+        failures is a list of (stage, exit code) tuples, and timings the
+        seconds taken by each stage that finished, failed or not.
+        '''
+
+        super(StageFailed, self).__init__(', '.join(
+            'stage %s failed with exit code %d' % (stage.name, returncode)
+            for stage, returncode in failures))
+        self.failures = failures
+        self.timings = timings
+
+def check_stages(stages):
+    '''
+    Raise ValueError unless the names of the stages are unique, and their
+    dependencies exist and don't form a cycle.
+    '''
+
+    deps = {}
+    for stage in stages:
+        if stage.name in deps:
+            raise ValueError('duplicate stage %s' % stage.name)
+        deps[stage.name] = stage.deps
+    for name, stage_deps in deps.items():
+        for dep in stage_deps:
+            if dep not in deps:
+                raise ValueError(
+                    'stage %s depends on unknown stage %s' % (name, dep))
+
+    done = set()
+    while len(done) < len(deps):
+        ready = [name for name, stage_deps in deps.items()
+            if name not in done and all(dep in done for dep in stage_deps)]
+        if not ready:
+            raise ValueError('the dependencies of stages %s form a cycle' %
+                ', '.join(sorted(set(deps) - done)))
+        done.update(ready)
+
+def run_stages(stages, env = None, cpus = None, keep_going = False):
+    '''
+    Run the stages, each as soon as its dependencies are done, in the
+    environment env updated with the stage's own. If cpus is given, stages
+    only start while the cpus of the stages running add up to at most that,
+    unless nothing else is running.
+
+    Returns a dict mapping the name of each stage to how many seconds it
+    took. If a stage fails, StageFailed is raised: right away, terminating
+    the stages still running, or with keep_going, only after all the stages
+    that don't depend on a failed one are done.
+    '''
+
+    check_stages(stages)
+    pending = list(stages)
+    running = [] # (stage, process, stdout, start time) tuples
+    done = set()
+    failed = set()
+    failures = []
+    timings = {}
+    try:
+        while pending or running:
+            for stage in list(pending):
+                if any(dep in failed for dep in stage.deps):
+                    log.info(':: skipping %s' % stage.name)
+                    pending.remove(stage)
+                    failed.add(stage.name)
+                    continue
+                if not all(dep in done for dep in stage.deps):
+                    continue
+                cpus_used = sum(s.cpus for s, _, _, _ in running)
+                if running and cpus is not None and \
+                    cpus_used + stage.cpus > cpus:
+                    continue
+                pending.remove(stage)
+                log.info(':: starting %s' % stage.name)
+                stdout = open(stage.stdout, 'w') if stage.stdout else None
+                process = subprocess.Popen(stage.command, stdout = stdout,
+                    env = dict(env if env is not None else os.environ,
+                        **stage.env))
+                running.append((stage, process, stdout, time.time()))
+
+            if not running:
+                continue
+            time.sleep(POLL_INTERVAL_SECONDS)
+            for item in list(running):
+                stage, process, stdout, start = item
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                running.remove(item)
+                if stdout is not None:
+                    stdout.close()
+                timings[stage.name] = time.time() - start
+                if returncode != 0:
+                    log.info(':: %s failed with exit code %d' % (
+                        stage.name, returncode))
+                    failed.add(stage.name)
+                    failures.append((stage, returncode))
+                    if not keep_going:
+                        raise StageFailed(failures, timings)
+                    continue
+                log.info(':: %s finished in %.1fs' % (
+                    stage.name, timings[stage.name]))
+                done.add(stage.name)
+    finally:
+        for stage, process, stdout, _ in running:
+            log.info(':: terminating %s' % stage.name)
+            process.terminate()
+            process.wait()
+            if stdout is not None:
+                stdout.close()
+    if failures:
+        raise StageFailed(failures, timings)
+    return timings
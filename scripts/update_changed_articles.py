@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+'''
+Incrementally update the CitationHunt database, without a dump.
+
+The revision of every page in the CitationHunt database is compared with the
+latest revision of the pages in the Wikipedia replica that need citations.
+Only the pages whose revision changed, or that started needing citations, are
+fetched from the MediaWiki API and parsed again, and the pages that no longer
+need citations are dropped. Pages whose new revision has the same wikitext
+as before are not parsed again.
+
+The result is left in the scratch database, which starts out as a copy of the
+current database, so assign_categories.py and install_new_database.py should
+be run next, as after parse_pages_articles.py.
+
+Usage:
+    update_changed_articles.py [--processes=<n>]
+
+Options:
+    --processes=<n>  Processes parsing articles (one per CPU but one if unset).
+'''
+
+from __future__ import unicode_literals
+
+import sys
+sys.path.append('../')
+
+import chdb
+import config
+import workerpool
+from parse_pages_articles import RowParser, DatabaseWriter, text_hash
+from utils import *
+
+import docopt
+import wikitools
+
+import itertools
+
+cfg = config.get_localized_config()
+WIKIPEDIA_API_URL = 'https://' + cfg.wikipedia_domain + '/w/api.php'
+
+NAMESPACE_ARTICLE = 0
+
+# The MediaWiki API returns the text of at most 50 pages per request
+API_PAGES_PER_REQUEST = 50
+
+# How many times to request a page again when a response leaves it out
+MAX_RETRIES_PER_PAGE = 3
+
+log = Logger()
+
+def load_latest_revisions(wpcursor):
+    '''
+    Return a dict mapping the pageid of each article that needs citations to
+    its latest revision id.
+    '''
+
+    wpcursor.execute('''
+        SELECT page_id, page_latest FROM categorylinks, page
+        WHERE cl_to = %s AND cl_from = page_id AND page_namespace = %s AND
+        NOT page_is_redirect''',
+        (cfg.citation_needed_category, NAMESPACE_ARTICLE))
+    return {unicode(pageid): rev_id for pageid, rev_id in wpcursor}
+
+def load_stored_revisions(cursor):
+    '''
+    Return a dict mapping the pageid of each article that was parsed into the
+    database to its (revision id, text hash) tuple.
+    '''
+
+    cursor.execute('''
+        SELECT page_id, rev_id, text_hash FROM articles UNION ALL
+        SELECT page_id, rev_id, text_hash FROM articles_without_snippets''')
+    return {pageid: (rev_id, wikitext_hash)
+        for pageid, rev_id, wikitext_hash in cursor}
+
+def fetch_latest_revisions(pageids):
+    '''
+    Fetch the latest revisions of the pages in pageids from the MediaWiki
+    API, yielding a (pageid, title, revision id, text) tuple for each. Pages
+    that are missing, or are no longer articles, are skipped, and so are
+    pages whose latest revision has its text hidden, which end up being
+    treated like deleted pages. So are pages that keep getting left out of
+    the responses after MAX_RETRIES_PER_PAGE attempts.
+    '''
+
+    wikipedia = wikitools.wiki.Wiki(WIKIPEDIA_API_URL)
+    pending = list(pageids)
+    retries = {}
+    while pending:
+        chunk = pending[:API_PAGES_PER_REQUEST]
+        del pending[:API_PAGES_PER_REQUEST]
+        response = wikitools.api.APIRequest(wikipedia, {
+            'action': 'query',
+            'prop': 'info|revisions',
+            'rvprop': 'ids|content',
+            'pageids': '|'.join(chunk),
+        }).query(querycontinue = False)
+        for page in response['query']['pages'].values():
+            if 'missing' in page or 'invalid' in page or 'redirect' in page or \
+                page['ns'] != NAMESPACE_ARTICLE:
+                continue
+            if 'revisions' not in page:
+                # the response got too large to include this page, so it
+                # has to be requested again
+                pageid = unicode(page['pageid'])
+                retries[pageid] = retries.get(pageid, 0) + 1
+                if retries[pageid] <= MAX_RETRIES_PER_PAGE:
+                    pending.append(pageid)
+                else:
+                    log.info('skipping page %s (%s), its text was left out '
+                        'of %d responses' % (pageid, d(page['title']),
+                        retries[pageid]))
+                continue
+            revision = page['revisions'][0]
+            if '*' not in revision:
+                # the text was hidden or suppressed ('texthidden')
+                continue
+            yield (unicode(page['pageid']), d(page['title']),
+                revision['revid'], d(revision['*']))
+
+def delete_pages(db, pageids):
+    def delete(cursor):
+        for chunk in chunks(list(pageids), PAGES_PER_QUERY):
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute('''
+                DELETE FROM snippets WHERE article_id IN (%s)''' %
+                placeholders, chunk)
+            cursor.execute('''
+                DELETE FROM articles WHERE page_id IN (%s)''' %
+                placeholders, chunk)
+            cursor.execute('''
+                DELETE FROM articles_without_snippets WHERE page_id IN (%s)''' %
+                placeholders, chunk)
+    db.execute_with_retry(delete)
+
+def update_revisions(db, revisions):
+    def update(cursor):
+        for table in ('articles', 'articles_without_snippets'):
+            cursor.executemany('''
+                UPDATE ''' + table + ''' SET rev_id = %s WHERE page_id = %s''',
+                [(rev_id, pageid) for pageid, rev_id in revisions])
+    db.execute_with_retry(update)
+
+def update_changed_articles(nparsers = None):
+    wpdb = chdb.init_wp_replica_db()
+    latest_revisions = load_latest_revisions(wpdb.cursor())
+    wpdb.close()
+
+    live_db = chdb.init_db(cfg.lang_code)
+    chdb.create_tables(live_db)
+    stored_revisions = load_stored_revisions(live_db.cursor())
+    live_db.close()
+    if not any(rev_id for rev_id, _ in stored_revisions.values()):
+        log.info('no revisions found in the database, a full update from '
+            'a dump is needed first!')
+        return 1
+
+    removed_pageids = set(stored_revisions) - set(latest_revisions)
+    changed_pageids = set(pageid
+        for pageid, rev_id in latest_revisions.iteritems()
+        if stored_revisions.get(pageid, (None, None))[0] != rev_id)
+    log.info('%d pages no longer need citations, %d pages are new or '
+        'changed' % (len(removed_pageids), len(changed_pageids)))
+
+    # the foreign keys are only created after all rows are written
+    chdb.reset_scratch_db(foreign_keys = False).close()
+    db = chdb.copy_db_to_scratch(
+        ['articles', 'snippets', 'articles_without_snippets'])
+    delete_pages(db, removed_pageids)
+
+    parser = RowParser()
+    writer = DatabaseWriter()
+    wp = workerpool.WorkerPool(parser, writer, batch_size = 10,
+        dispatch = 'shared', nworkers = nparsers)
+    unchanged_revisions = []
+    fetched_pageids = set()
+    nparsed = 0
+    pages = fetch_latest_revisions(sorted(changed_pageids))
+    for chunk in iter(
+        lambda: list(itertools.islice(pages, PAGES_PER_QUERY)), []):
+        to_parse = []
+        for pageid, title, rev_id, wikitext in chunk:
+            fetched_pageids.add(pageid)
+            _, stored_hash = stored_revisions.get(pageid, (None, None))
+            if stored_hash == text_hash(wikitext):
+                unchanged_revisions.append((pageid, rev_id))
+            else:
+                to_parse.append((pageid, title, rev_id, wikitext))
+        # the old rows must be gone before the writers insert the new ones
+        delete_pages(db, [info[0] for info in to_parse])
+        for info in to_parse:
+            wp.post(('article', info))
+        nparsed += len(to_parse)
+        log.progress('posted %d pages for parsing' % nparsed)
+    wp.done()
+    update_revisions(db, unchanged_revisions)
+    # pages deleted, turned into redirects or whose text was hidden since we
+    # looked at the replica
+    delete_pages(db, changed_pageids - fetched_pageids)
+    log.info('parsed %d pages, %d had the same text as before' %
+        (nparsed, len(unchanged_revisions)))
+
+    log.info('creating foreign keys...')
+    chdb.create_foreign_keys(db)
+    db.close()
+    return 0
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    nparsers = arguments['--processes']
+    sys.exit(update_changed_articles(
+        int(nparsers) if nparsers is not None else None))
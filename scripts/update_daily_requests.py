@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+'''
+Aggregate the requests logged since the last run into the daily_requests
+table, which backs the stats pages. This is meant to run periodically, for
+instance hourly as a cron job.
+
+It also brings a requests table created by an older version up to date, see
+chdb.upgrade_stats_db, so it should be run once after upgrading, before the
+web app starts logging requests.
+'''
+
+import sys
+sys.path.append('../')
+
+import chdb
+from crawlers import crawler_classifier
+
+def classify_requests(cursor):
+    '''
+    Fill in is_crawler for requests that were logged before it existed.
+    '''
+
+    cursor.execute('''
+        SELECT DISTINCT user_agent FROM requests WHERE is_crawler IS NULL''')
+    user_agents = [user_agent for user_agent, in cursor]
+    if not user_agents:
+        return
+    crawler_user_agents = [user_agent for user_agent in user_agents
+        if user_agent is not None and
+        crawler_classifier.is_crawler(user_agent)]
+    cursor.execute('''
+        UPDATE requests SET is_crawler = COALESCE(user_agent IN (%s), FALSE)
+        WHERE is_crawler IS NULL''' %
+        ', '.join(['%s'] * len(crawler_user_agents) or ['NULL']),
+        crawler_user_agents)
+
+def update_daily_requests(cursor):
+    '''
+    Aggregate the requests logged since the last call into daily_requests.
+
+    The most recent day in daily_requests is recomputed, as it may have been
+    incomplete when it was last aggregated. Days are in UTC, like the
+    timestamps of the requests, so they don't depend on the time zone of the
+    web app or the database.
+    '''
+
+    classify_requests(cursor)
+
+    cursor.execute('SELECT MAX(dt) FROM daily_requests')
+    start = cursor.fetchone()[0]
+    if start is None:
+        cursor.execute('SELECT DATE(MIN(ts)) FROM requests')
+        start = cursor.fetchone()[0]
+        if start is None:
+            return
+
+    cursor.execute('DELETE FROM daily_requests WHERE dt >= %s', (start,))
+    cursor.execute('''
+        INSERT INTO daily_requests
+        SELECT DATE(ts) AS dt, lang_code, category_id, referrer, user_agent,
+        is_crawler, COUNT(*), SUM(snippet_id IS NOT NULL) FROM requests
+        WHERE ts >= %s AND status_code = 200
+        GROUP BY dt, lang_code, category_id, referrer, user_agent,
+        is_crawler
+    ''', (start,))
+
+if __name__ == '__main__':
+    db = chdb.init_stats_db()
+    db.execute_with_retry(chdb.upgrade_stats_db)
+    db.execute_with_retry(update_daily_requests)
+    db.close()
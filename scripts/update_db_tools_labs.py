@@ -1,5 +1,21 @@
 #!/usr/bin/env python
 
+'''
+Update the CitationHunt databases of one or more languages on Tools Labs.
+
+The update is split into stages, each running one of the scripts in this
+directory, which are run by stages.run_stages as soon as the stages they
+depend on are done. In particular, the categories of the unsourced pages are
+loaded from the replica while the dump is being parsed.
+
+The stages of all languages are run by the same scheduler, within a single
+budget of CPUs, which is split equally between the languages. One CPU of
+each language's share is set aside for its smaller stages, and the rest go
+to its parsing stage: to the processes that parse articles, but also to
+those that read the dump and write to the database. A language that fails
+doesn't stop the others.
+'''
+
 import os
 import sys
 
@@ -7,23 +23,195 @@ script_dir = os.path.dirname(__file__)
 sys.path.append(os.path.join(script_dir, '..'))
 
 import config
+import stages
+from utils import *
 
 import argparse
+import multiprocessing
+import shutil
+import subprocess
+import time
+
+HOME_DIR = os.path.expanduser('~')
+VENV_BIN_DIR = os.path.join(HOME_DIR, 'www', 'python', 'venv', 'bin')
+SRC_DIR = os.path.join(HOME_DIR, 'www', 'python', 'src')
+LOG_FILE = os.path.join(HOME_DIR, 'update_db_tools_labs.err')
+DUMPS_DIR = '/public/dumps/public'
+
+# The most processes parse_pages_articles.py gets to read the dump and to
+# write to the database, out of the CPUs of its stage.
+MAX_DUMP_READERS = 4
+MAX_DUMP_WRITERS = 2
+
+# update_changed_articles.py always uses a single database writer
+INCREMENTAL_WRITERS = 1
+
+log = Logger()
+
+def email(subject):
+    mail = subprocess.Popen(['/usr/bin/mail', '-s', subject, '-a', LOG_FILE,
+        'citationhunt.update@tools.wmflabs.org'], stdin = subprocess.PIPE)
+    mail.communicate('The logs are attached.\n')
+    time.sleep(120)
+
+def write_mysql_configs(cfgs):
+    # FIXME user and password need to be unquoted in ~/replica.my.cnf
+    replica_my_cnf = os.path.join(HOME_DIR, 'replica.my.cnf')
+    if not os.path.isfile(replica_my_cnf):
+        return
+    if not os.path.exists('ch.my.cnf'):
+        shutil.copy(replica_my_cnf, 'ch.my.cnf')
+        with open('ch.my.cnf', 'a') as f:
+            f.write('host=tools-db\n')
+    # each language's replica is on its own host, see chdb.init_wp_replica_db
+    for cfg in cfgs:
+        wp_my_cnf = 'wp_%s.my.cnf' % cfg.lang_code
+        shutil.copy(replica_my_cnf, wp_my_cnf)
+        with open(wp_my_cnf, 'a') as f:
+            f.write('host=%swiki.labsdb\n' % cfg.lang_code)
+
+def find_latest_dump(cfg):
+    '''
+    Return the arguments for parse_pages_articles.py to read the latest dump,
+    or None if it's not there.
+    '''
+
+    xxwiki = cfg.lang_code + 'wiki'
+    dump_base_dir = os.path.join(DUMPS_DIR, xxwiki)
+    dump_date = sorted(os.listdir(dump_base_dir))[-1]
+    log.info(':: latest dump is %s' % dump_date)
+    dump_prefix = os.path.join(
+        dump_base_dir, dump_date, '%s-%s-' % (xxwiki, dump_date))
+
+    multistream_xml_bz2 = dump_prefix + 'pages-articles-multistream.xml.bz2'
+    multistream_index_bz2 = \
+        dump_prefix + 'pages-articles-multistream-index.txt.bz2'
+    if os.path.isfile(multistream_xml_bz2) and \
+        os.path.isfile(multistream_index_bz2):
+        return ['--multistream-index=' + multistream_index_bz2,
+            multistream_xml_bz2]
+
+    pages_articles_xml_bz2 = dump_prefix + 'pages-articles.xml.bz2'
+    if os.path.isfile(pages_articles_xml_bz2):
+        return [pages_articles_xml_bz2]
+    return None
+
+def make_stages(cfg, dump_args, cpus):
+    '''
+    The stages of an update from the dump given by dump_args, as returned by
+    find_latest_dump, or of an incremental update if it's None, using up to
+    cpus CPUs at a time. The stages' names and the files they write are
+    prefixed with the language code.
+    '''
+
+    lang_code = cfg.lang_code
+    def name(stage_name):
+        return '%s:%s' % (lang_code, stage_name)
+    unsourced = 'unsourced_' + lang_code
+    categories_pkl = 'categories_%s.pkl' % lang_code
+    env = {'CH_LANG': lang_code}
+
+    # one CPU is left for the smaller stages
+    parse_cpus = max(cpus - 1, 1)
+    if dump_args is not None:
+        readers = min(MAX_DUMP_READERS, max(parse_cpus // 4, 1))
+        writers = min(MAX_DUMP_WRITERS, max(parse_cpus // 4, 1))
+        processes = max(parse_cpus - readers - writers, 1)
+        parse_cache_dir = os.path.join(HOME_DIR, 'parse_cache_' + lang_code)
+        parse_stage = stages.Stage(name('parse'),
+            ['./parse_pages_articles.py', '--readers=%d' % readers,
+            '--writers=%d' % writers, '--processes=%d' % processes,
+            '--parse-cache=' + parse_cache_dir,
+            '--stats-file=stats_%s.pkl' % lang_code] +
+            dump_args + [unsourced],
+            deps = [name('unsourced')], env = env,
+            cpus = readers + writers + processes)
+    else:
+        processes = max(parse_cpus - INCREMENTAL_WRITERS, 1)
+        parse_stage = stages.Stage(name('parse'),
+            ['./update_changed_articles.py', '--processes=%d' % processes],
+            env = env, cpus = INCREMENTAL_WRITERS + processes)
+
+    return [
+        stages.Stage(name('unsourced'),
+            ['./print_unsourced_pageids_from_wikipedia.py'],
+            stdout = unsourced, env = env),
+        parse_stage,
+        stages.Stage(name('load_categories'),
+            ['./load_categories.py', unsourced, categories_pkl],
+            deps = [name('unsourced')], env = env),
+        stages.Stage(name('assign_categories'),
+            ['./assign_categories.py',
+            '--max-categories=%s' % cfg.max_categories,
+            '--categories-file=' + categories_pkl],
+            deps = [name('parse'), name('load_categories')], env = env),
+        stages.Stage(name('install'), ['./install_new_database.py'],
+            deps = [name('assign_categories')], env = env),
+    ]
+
+def update_db_tools_labs(cfgs, incremental, cpus):
+    open(LOG_FILE, 'w').close()
+    os.chdir(SRC_DIR)
+    write_mysql_configs(cfgs)
+    os.chdir('scripts')
+
+    errors = []
+    all_stages = []
+    cpus_per_language = max(cpus // len(cfgs), 1)
+    for cfg in cfgs:
+        dump_args = None
+        if not incremental:
+            dump_args = find_latest_dump(cfg)
+            if dump_args is None:
+                log.info('no xml.bz2 file found for %s, maybe the dump is in '
+                    'progress?' % cfg.lang_code)
+                errors.append('%s: pages-articles.xml.bz2 not found' %
+                    cfg.lang_code)
+                continue
+        all_stages.extend(make_stages(cfg, dump_args, cpus_per_language))
+
+    env = dict(os.environ,
+        VIRTUAL_ENV = os.path.dirname(VENV_BIN_DIR),
+        PATH = VENV_BIN_DIR + os.pathsep + os.environ.get('PATH', ''))
+    try:
+        timings = stages.run_stages(
+            all_stages, env, cpus = cpus, keep_going = True)
+    except stages.StageFailed as failure:
+        timings = failure.timings
+        errors.extend('%s failed at %s' % (
+            stage.env['CH_LANG'], os.path.basename(stage.command[0]))
+            for stage, _ in failure.failures)
+
+    for name, seconds in sorted(timings.items(), key = lambda t: -t[1]):
+        log.info('%s took %.1fs' % (name, seconds))
+    if errors:
+        email('Failed: ' + '; '.join(errors))
+        return 1
+    email('All done!')
+    return 0
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Update the CitationHunt databases.')
-    parser.add_argument('--lang-code', dest = 'lang_code',
-        help='One of the language codes in ../config.py')
+    parser.add_argument('--lang-code', dest = 'lang_codes',
+        action = 'append', required = True,
+        help='One of the language codes in ../config.py. Can be given '
+        'several times to update several languages')
+    parser.add_argument('--incremental', action='store_true',
+        help='Only update the articles that changed since the last update, '
+        'instead of parsing the latest dump')
+    parser.add_argument('--cpus', type = int,
+        default = multiprocessing.cpu_count(),
+        help='How many CPUs to use for all languages (default: all of them)')
     args = parser.parse_args()
 
-    if args.lang_code not in config.lang_code_to_config:
-        print >>sys.stderr, 'Invalid lang code! Use one of: ',
-        print >>sys.stderr, config.lang_code_to_config.keys()
-        parser.print_usage()
-        sys.exit(1)
+    for lang_code in args.lang_codes:
+        if lang_code not in config.lang_code_to_config:
+            print >>sys.stderr, 'Invalid lang code! Use one of: ',
+            print >>sys.stderr, config.lang_code_to_config.keys()
+            parser.print_usage()
+            sys.exit(1)
 
-    cfg = config.get_localized_config(args.lang_code)
-    os.environ['CH_LANG'] = args.lang_code
-    os.environ['CH_MAX_CATEGORIES'] = str(cfg.max_categories)
-    sys.exit(os.system(os.path.join(script_dir, 'update_db_tools_labs.sh')))
+    cfgs = [config.get_localized_config(lang_code)
+        for lang_code in sorted(set(args.lang_codes))]
+    sys.exit(update_db_tools_labs(cfgs, args.incremental, args.cpus))
@@ -1,21 +1,27 @@
 import os
 import abc
+import time
 import signal
 import itertools
-import Queue # Queue.Empty
+import threading
+import Queue # Queue.Empty, Queue.Full
 import multiprocessing
 
+class WorkerPoolError(Exception):
+    pass
+
 class WorkerPool(object):
     '''
     A pool of worker processes, somewhat similar to multiprocessing.Pool, but
     more suitable for data generated lazily or in an event-driven manner, and
     adopting a MapReduce-like working model.
 
-    A WorkerPool consists of multiprocessing.cpu_count() processes, one of
-    which being the receiver (which is similar to a reducer), and the others
-    being workers (which are analogous to mappers). The receiver and the
-    workers must conform to the Receiver and Worker interfaces defined by this
-    module, which consist of the setup(), work()/receive() and done() methods.
+    A WorkerPool consists of multiprocessing.cpu_count() processes (or
+    nworkers + 1, if given), one of which being the receiver (which is similar
+    to a reducer), and the others being workers (which are analogous to
+    mappers). The receiver and the workers must conform to the Receiver and
+    Worker interfaces defined by this module, which consist of the setup(),
+    work()/receive() and done() methods.
 
     The setup() method will get called right after forking, but before any tasks
     are sent to the workers and receiver. Likewise, the done() method will get
@@ -29,6 +35,31 @@ class WorkerPool(object):
     WorkerPool suitable for large datasets that are generated lazily or via
     event-driven libraries.
 
+    Each object passed to WorkerPool.post() and each result normally gets sent
+    to its process on its own, which can be costly for many small tasks. With
+    a batch_size larger than 1, both tasks and results are sent in batches of
+    up to that many objects instead. Incomplete batches get sent after waiting
+    for flush_interval seconds, so a slow producer doesn't stall the workers.
+
+    By default, tasks are handed out to the workers in turns, each worker
+    having its own queue. That can leave tasks waiting behind a slow one while
+    other workers are idle, so with dispatch = 'shared' all workers take tasks
+    from a single queue instead, as soon as they're free.
+
+    Queues are unbounded by default, so if the workers or the receiver fall
+    behind, tasks and results pile up in memory. With a queue_size larger than
+    0, each queue holds at most that many messages (tasks, or batches of
+    them), and WorkerPool.post() and the workers block when they're full. The
+    time spent blocked that way is returned by blocked_seconds(). If the
+    processes reading from a full queue have died, or any subprocess has
+    exited with an error, WorkerPool.post() and WorkerPool.done() cancel the
+    pool and raise WorkerPoolError instead of waiting forever.
+
+    There can also be more than one receiver, if nreceivers is given, in which
+    case each of them gets a copy of the receiver object. Each result then
+    goes to the receiver numbered partition(result) % nreceivers, or to the
+    receivers in turns if no partition function is given.
+
     A WorkerPool can also be canceled with the cancel() method. This will cause
     SIGTERM to be sent to all child processes, which will intercept it, call
     their respective Worker/Receiver's done() method, and exit gracefully.
@@ -78,63 +109,194 @@ class WorkerPool(object):
     # the last one and give up on that subprocess
     MAX_EXCEPTIONS_PER_SUBPROCESS = 5
 
-    def __init__(self, worker, receiver):
-        self._procs = []
-        self._queues = []
-        self._canceled = False
+    DISPATCH_MODES = ('round-robin', 'shared')
 
-        # receiver process and queue
-        self._queues.append(multiprocessing.Queue())
-        self._procs.append(
-            multiprocessing.Process(
-                target = self._receiver_loop, args = (receiver,)))
-        self._procs[0].start()
-
-        # worker processes and queues
-        nprocs = multiprocessing.cpu_count() - 1
-        for _ in range(nprocs):
-            q = multiprocessing.Queue()
-            self._queues.append(q)
+    def __init__(self, worker, receiver, batch_size = 1, flush_interval = 1,
+        dispatch = 'round-robin', nworkers = None, queue_size = 0,
+        nreceivers = 1, partition = None):
+        if dispatch not in self.DISPATCH_MODES:
+            raise ValueError('unknown dispatch mode: %r' % dispatch)
+
+        self._canceled = False
+        self._pid = os.getpid()
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._partition = partition
+
+        # seconds spent waiting for room in the workers' and receivers' queues
+        self._tasks_blocked_seconds = 0.0
+        self._results_blocked_seconds = multiprocessing.Value('d', 0.0)
+
+        # receiver processes and queues
+        self._receiver_procs = []
+        self._receiver_queues = []
+        for _ in range(nreceivers):
+            q = multiprocessing.Queue(queue_size)
+            self._receiver_queues.append(q)
+            p = multiprocessing.Process(
+                target = self._receiver_loop, args = (receiver, q))
+            p.start()
+            self._receiver_procs.append(p)
+
+        # worker processes and queues. with shared dispatch, the same queue
+        # appears once per worker, so each of them still gets a 'DONE'.
+        if nworkers is None:
+            nworkers = max(multiprocessing.cpu_count() - 1, 1)
+        if dispatch == 'shared':
+            shared_queue = multiprocessing.Queue(queue_size)
+        self._worker_procs = []
+        self._worker_queues = []
+        for _ in range(nworkers):
+            if dispatch == 'shared':
+                q = shared_queue
+            else:
+                q = multiprocessing.Queue(queue_size)
+            self._worker_queues.append(q)
             p = multiprocessing.Process(
                 target = self._worker_loop, args = (worker, q))
             p.start()
-            self._procs.append(p)
-        self._cycle_worker_queues = itertools.cycle(self._queues[1:])
+            self._worker_procs.append(p)
+        self._cycle_worker_queues = itertools.cycle(self._worker_queues)
+
+        # tasks waiting to be sent to the workers
+        self._batch = []
+        self._batch_deadline = None
+        self._batch_lock = threading.Lock()
+        self._closed = False
+        if batch_size > 1:
+            flusher = threading.Thread(target = self._flush_loop)
+            flusher.daemon = True
+            flusher.start()
 
     def post(self, obj):
-        q = next(self._cycle_worker_queues)
-        q.put(('TASK', obj))
+        with self._batch_lock:
+            if not self._batch:
+                self._batch_deadline = time.time() + self._flush_interval
+            self._batch.append(obj)
+            if len(self._batch) >= self._batch_size:
+                self._flush_batch()
 
     def done(self):
+        with self._batch_lock:
+            self._flush_batch()
+            self._closed = True
+
         # stop workers
-        for q in self._queues[1:]:
-            q.put(('DONE', None))
-        for p in self._procs[1:]:
+        for q in self._worker_queues:
+            self._put(q, ('DONE', None))
+        for p in self._worker_procs:
+            p.join()
+
+        # stop receivers
+        for q in self._receiver_queues:
+            self._put(q, ('DONE', None))
+        for p in self._receiver_procs:
             p.join()
 
-        self._queues[0].put(('DONE', None))
-        self._procs[0].join()
+    def blocked_seconds(self):
+        '''
+        Return how many seconds were spent waiting for room in the queues, as
+        a dictionary with two keys: 'tasks', for the time WorkerPool.post()
+        waited for the workers, and 'results', for the time the workers
+        waited for the receiver, summed over all workers.
+        '''
+
+        return {
+            'tasks': self._tasks_blocked_seconds,
+            'results': self._results_blocked_seconds.value,
+        }
 
     def cancel(self):
-        for p in self._procs:
-            os.kill(p.pid, signal.SIGTERM)
-        for p in self._procs:
+        self._canceled = True
+        # don't wait to flush messages nobody may ever read
+        for q in self._worker_queues + self._receiver_queues:
+            q.cancel_join_thread()
+        procs = self._receiver_procs + self._worker_procs
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+        for p in procs:
             p.join()
 
+    def _flush_batch(self):
+        # must be called with self._batch_lock held
+        if self._batch:
+            q = next(self._cycle_worker_queues)
+            self._tasks_blocked_seconds += self._put(
+                q, ('TASKS', self._batch))
+            self._batch = []
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self._flush_interval)
+            with self._batch_lock:
+                if self._closed:
+                    return
+                if self._batch and time.time() >= self._batch_deadline:
+                    self._flush_batch()
+
+    def _put(self, q, msg):
+        '''
+        Put msg in q, waiting for as long as it's full, unless we get canceled.
+        Returns how many seconds we waited, which is 0 unless q was full, and
+        so always 0 for unbounded queues.
+        '''
+
+        # only time spent waiting for room counts as blocked, not the time
+        # put() takes to hand msg over to the queue's feeder thread
+        try:
+            q.put_nowait(msg)
+            return 0.0
+        except Queue.Full:
+            pass
+        start = time.time()
+        while not self._canceled:
+            try:
+                q.put(msg, timeout = 1)
+                break
+            except Queue.Full:
+                self._check_subprocesses(q)
+        return time.time() - start
+
+    def _check_subprocesses(self, q):
+        '''
+        Called while waiting for room in q. In the parent process, cancel the
+        pool and raise WorkerPoolError if any subprocess exited with an error,
+        or if all the processes reading from q are gone, as q would then never
+        have room again. Workers waiting on a dead receiver are stopped by the
+        cancellation.
+        '''
+
+        if os.getpid() != self._pid:
+            return
+        procs = self._receiver_procs + self._worker_procs
+        failed = [p for p in procs if p.exitcode not in (None, 0)]
+        readers = [p for p, pq in
+            zip(self._worker_procs, self._worker_queues) +
+            zip(self._receiver_procs, self._receiver_queues) if pq is q]
+        if failed or not any(p.is_alive() for p in readers):
+            self.cancel()
+            raise WorkerPoolError('%s exited with code %s' % (
+                ', '.join(p.name for p in failed or readers),
+                ', '.join(str(p.exitcode) for p in failed or readers)))
+
     def _sigterm_handler(self, sig, stack):
         self._canceled = True
 
-    def _loop_common(self, q, on_task):
+    def _loop_common(self, q, on_task, on_idle = lambda: None):
         signal.signal(signal.SIGTERM, self._sigterm_handler)
         exception_count = 0
         while not self._canceled:
             try:
-                msg, task = q.get(timeout = 1)
+                msg, tasks = q.get(timeout = self._flush_interval)
             except Queue.Empty:
+                on_idle()
                 continue
             if msg == 'DONE':
                 break
-            if not self._canceled:
+            for task in tasks:
+                if self._canceled:
+                    break
                 try:
                     on_task(task)
                 except:
@@ -143,18 +305,43 @@ class WorkerPool(object):
                         raise
 
     def _worker_loop(self, worker, q):
+        # results waiting to be sent to each receiver
+        results = [[] for _ in self._receiver_queues]
+        cycle_receivers = itertools.cycle(range(len(self._receiver_queues)))
+        def flush_results(i):
+            if results[i]:
+                blocked = self._put(
+                    self._receiver_queues[i], ('TASKS', results[i]))
+                with self._results_blocked_seconds.get_lock():
+                    self._results_blocked_seconds.value += blocked
+                results[i] = []
+        def flush_all_results():
+            for i in range(len(results)):
+                flush_results(i)
         def on_task(task):
             result = worker.work(task)
-            self._queues[0].put(('TASK', result))
+            if self._partition is not None:
+                i = self._partition(result) % len(results)
+            else:
+                i = next(cycle_receivers)
+            results[i].append(result)
+            if len(results[i]) >= self._batch_size:
+                flush_results(i)
         worker.setup()
-        self._loop_common(q, on_task)
+        self._loop_common(q, on_task, flush_all_results)
+        if not self._canceled:
+            flush_all_results()
+        else:
+            # results may be left unread if the receivers are gone
+            for rq in self._receiver_queues:
+                rq.cancel_join_thread()
         worker.done()
 
-    def _receiver_loop(self, receiver):
+    def _receiver_loop(self, receiver, q):
         def on_task(task):
             receiver.receive(task)
         receiver.setup()
-        self._loop_common(self._queues[0], on_task)
+        self._loop_common(q, on_task)
         receiver.done()
 
 class Worker(object):
@@ -1,2 +1,3 @@
-from base import REF_MARKER, CITATION_NEEDED_MARKER
+from base import REF_MARKER, CITATION_NEEDED_MARKER, PARSER_VERSION
 from base import get_localized_snippet_parser
+from base import create_snippet_parser
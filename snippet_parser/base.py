@@ -9,53 +9,255 @@ _upper_dir = os.path.abspath(
 if _upper_dir not in sys.path:
     sys.path.append(_upper_dir)
 
+# the localized parsers are imported by their language code
+_this_dir = os.path.abspath(os.path.dirname(__file__))
+if _this_dir not in sys.path:
+    sys.path.append(_this_dir)
+
 import config
+from utils import d
+
+import importlib
+import re
 
 import mwparserfromhell
+from mwparserfromhell.definitions import is_visible, PARSER_BLACKLIST
 
 REF_MARKER = 'ec5b89dc49c433a9521a139'
 CITATION_NEEDED_MARKER = '7b94863f3091b449e6ab04d4'
 
+# Bump this whenever a change to the parsers changes the snippets they
+# extract, so results cached with the previous version are not used.
+PARSER_VERSION = 2
+
+STRIP_REGEXP = re.compile( # strip spaces before the markers
+    '\s+(' + CITATION_NEEDED_MARKER + '|' + REF_MARKER + ')')
+
+# The tokens that determine the top-level structure of an article: openings
+# and closings of templates and tables, comments, blank lines and headings.
+# Comments and the bodies of tags like <pre> and <nowiki>, whose contents
+# mwparserfromhell doesn't parse, are matched whole, so nothing inside them
+# counts.
+STRUCTURE_REGEXP = re.compile(
+    r'(\{\{|^[ \t]*\{\|)|(\}\}|^[ \t]*\|\})|<!--.*?-->|'
+    r'<(' + '|'.join(PARSER_BLACKLIST) + r')(?:\s[^>]*)?(?<!/)>.*?</\3\s*>|'
+    r'(\n\n)|^(=+[^\n]*=+)(?:[ \t]|<!--.*?-->)*$',
+    re.MULTILINE | re.DOTALL | re.IGNORECASE)
+
+def create_snippet_parser(cfg):
+    '''
+    Return a snippet parser for the language of cfg, as returned by
+    config.get_localized_config. Parsers for different languages don't share
+    any state, so they can be used side by side in the same process.
+    '''
+
+    localized_module = importlib.import_module(cfg.lang_code)
+    return localized_module.SnippetParser(cfg)
+
 def get_localized_snippet_parser():
-    import snippet_parser # requires CH_LANG
-    return snippet_parser
+    return create_snippet_parser(
+        config.get_localized_config()) # requires CH_LANG
+
+def cleanup_snippet(snippet):
+    snippet = re.sub(STRIP_REGEXP, r'\1', snippet).strip()
+    snippet = re.sub(',\s+\)', ')', snippet)
+    return re.sub('\(\)', '', snippet)
+
+def split_sections(wikicode):
+    '''
+    Split the top-level nodes of wikicode into sections.
+
+    Returns a list of [title, nodes] pairs, starting with the lead section,
+    whose title is empty. The headings themselves are not included in the
+    nodes, as they're always stripped from the snippets.
+    '''
+
+    sections = [['', []]]
+    for node in wikicode.nodes:
+        if isinstance(node, mwparserfromhell.nodes.Heading):
+            sections.append([unicode(node.title.strip()), []])
+        else:
+            sections[-1][1].append(node)
+    return sections
 
-def matches_any(template, names):
-    return any(template.name.matches(n) for n in names)
+def split_paragraphs(nodes):
+    '''
+    Split a list of nodes into paragraphs, which are separated by blank lines
+    in the top-level text nodes. Yields a Wikicode object per paragraph.
+    '''
 
-# (s)anitize (p)arameters from a template
-def sp(params):
-    if isinstance(params, mwparserfromhell.nodes.extras.Parameter):
-        params = [params]
-    sanitized = [unicode(p.value.strip_code()) for p in params]
-    return sanitized[0] if len(sanitized) == 1 else sanitized
+    paragraph = []
+    for node in nodes:
+        if isinstance(node, mwparserfromhell.nodes.Text) and \
+            '\n\n' in node.value:
+            lines = node.value.split('\n\n')
+            paragraph.append(mwparserfromhell.nodes.Text(lines[0]))
+            for line in lines[1:]:
+                yield mwparserfromhell.wikicode.Wikicode(paragraph)
+                paragraph = [mwparserfromhell.nodes.Text(line)]
+        else:
+            paragraph.append(node)
+    yield mwparserfromhell.wikicode.Wikicode(paragraph)
+
+def scan_article(wikitext):
+    '''
+    Find the top-level headings and paragraphs of wikitext without parsing it.
+
+    Returns a list with the title of each heading, and a (start, end) span
+    for each paragraph, in the order in which they appear. Blank lines and
+    headings inside templates, tables, comments or tags whose contents aren't
+    parsed, such as <pre>, are ignored, like when splitting the parsed
+    wikicode. If the templates and tables don't seem to
+    be balanced, we can't tell what's inside them, so the whole article is
+    returned as a single paragraph to be parsed and split as usual.
+    '''
+
+    items = []
+    depth = 0
+    start = 0
+    for match in STRUCTURE_REGEXP.finditer(wikitext):
+        opening, closing, _, blank, heading = match.groups()
+        if opening:
+            depth += 1
+        elif closing:
+            depth -= 1
+            if depth < 0:
+                break
+        elif depth == 0 and (blank or heading and heading.strip('=')):
+            items.append((start, match.start()))
+            if heading:
+                level = min(
+                    len(heading) - len(heading.lstrip('=')),
+                    len(heading) - len(heading.rstrip('=')), 6)
+                items.append(heading[level:-level].strip())
+            start = match.end()
+    if depth != 0:
+        return [(0, len(wikitext))]
+    items.append((start, len(wikitext)))
+    return items
+
+def is_usable_snippet(snippet, minlen, maxlen):
+    if CITATION_NEEDED_MARKER not in snippet:
+        # marker may have been inside wiki markup
+        return False
+
+    usable_len = (
+        len(snippet) -
+        (len(CITATION_NEEDED_MARKER) *
+            snippet.count(CITATION_NEEDED_MARKER)) -
+        (len(REF_MARKER) *
+            snippet.count(REF_MARKER)))
+    return minlen <= usable_len <= maxlen
 
 class SnippetParserBase(object):
-    '''A base class for snippet parsers in various languages.'''
-
-    def __init__(self):
-        # Monkey-patch mwparserfromhell to use our own methods.
-        monkey_patched_classes = {
-            mwparserfromhell.nodes.Template: self.strip_template,
-            mwparserfromhell.nodes.Tag: self.strip_tag,
-            mwparserfromhell.nodes.Wikilink: self.strip_wikilink,
+    '''A base class for snippet parsers in various languages.
+
+    Wikicode is stripped with strip_code, which looks up how to strip each
+    node in a table of this parser's own methods, rather than in the
+    __strip__ methods of mwparserfromhell's nodes, which are left untouched.
+    '''
+
+    def __init__(self, cfg = None):
+        self.cfg = cfg if cfg is not None else config.get_localized_config()
+
+        # Matches the beginning of any of the citation needed templates,
+        # ignoring case, so it can only err on the side of finding too many of
+        # them. Templates are matched by their stripped name, so skip
+        # whitespace and comments before it.
+        self.citation_needed_regexp = re.compile(
+            r'\{\{(?:\s|<!--.*?-->)*(?:' +
+            '|'.join(re.escape(name)
+                for name in self.cfg.citation_needed_templates) +
+            r')(?=[\s|}<])', re.IGNORECASE | re.UNICODE | re.DOTALL)
+
+        # The nodes not in this table are stripped entirely, which notably
+        # includes headings.
+        nodes = mwparserfromhell.nodes
+        self._strip_methods = {
+            nodes.Template: self.strip_template,
+            nodes.Tag: self.strip_tag,
+            nodes.Wikilink: self.strip_wikilink,
+            nodes.Text: self._strip_text,
+            nodes.HTMLEntity: self._strip_html_entity,
+            nodes.ExternalLink: self._strip_external_link,
+            nodes.Argument: self._strip_argument,
         }
+        # What delegate_strip does, same as mwparserfromhell
+        self._default_strip_methods = {
+            nodes.Tag: self._strip_tag_contents,
+            nodes.Wikilink: self._strip_wikilink_text,
+        }
+
+    def strip_code(self, wikicode, normalize = True, collapse = True):
+        '''Like wikicode.strip_code(), but with this parser's methods.'''
 
-        # Always strip headings entirely
-        mwparserfromhell.nodes.Heading.__strip__ = \
-        mwparserfromhell.nodes.Node.__strip__
+        stripped_nodes = []
+        for node in wikicode.nodes:
+            strip = self._strip_methods.get(type(node))
+            if strip is None:
+                continue
+            stripped = strip(node, normalize, collapse)
+            if stripped:
+                stripped_nodes.append(unicode(stripped))
 
-        self._original_strip_methods = {}
-        for klass, method in monkey_patched_classes.items():
-            self._original_strip_methods[klass] = klass.__strip__
-            def unbind(self, *args):
-                return monkey_patched_classes[type(self)](self, *args)
-            klass.__strip__ = unbind
+        stripped = ''.join(stripped_nodes)
+        if collapse:
+            stripped = stripped.strip('\n')
+            while '\n\n\n' in stripped:
+                stripped = stripped.replace('\n\n\n', '\n\n')
+        return stripped
 
     def delegate_strip(self, obj, normalize, collapse):
-        strip = self._original_strip_methods[type(obj)]
-        strip = strip.__get__(obj, type(obj)) # bind the method
-        return strip(normalize, collapse)
+        return self._default_strip_methods[type(obj)](obj, normalize, collapse)
+
+    def _strip_text(self, text, normalize, collapse):
+        return text
+
+    def _strip_html_entity(self, entity, normalize, collapse):
+        return entity.normalize() if normalize else entity
+
+    def _strip_external_link(self, link, normalize, collapse):
+        if not link.brackets:
+            return self.strip_code(link.url, normalize, collapse)
+        if link.title:
+            return self.strip_code(link.title, normalize, collapse)
+        return None
+
+    def _strip_argument(self, argument, normalize, collapse):
+        if argument.default is not None:
+            return self.strip_code(argument.default, normalize, collapse)
+        return None
+
+    def _strip_tag_contents(self, tag, normalize, collapse):
+        if tag.contents and is_visible(tag.tag):
+            return self.strip_code(tag.contents, normalize, collapse)
+        return None
+
+    def _strip_wikilink_text(self, wikilink, normalize, collapse):
+        if wikilink.text is not None:
+            return self.strip_code(wikilink.text, normalize, collapse)
+        return self.strip_code(wikilink.title, normalize, collapse)
+
+    def template_matches(self, template, names):
+        '''
+        Like template.name.matches(names), but with the template's name
+        stripped by this parser's strip_code. names is a name or a tuple of
+        names, which are matched ignoring the case of their first letter.
+        '''
+
+        if isinstance(names, basestring):
+            names = (names,)
+        name = self.strip_code(template.name).strip()
+        normalized = name[:1].upper() + name[1:]
+        return any(normalized == n[:1].upper() + n[1:] for n in names)
+
+    def sp(self, params):
+        '''(s)anitize (p)arameters from a template'''
+
+        if isinstance(params, mwparserfromhell.nodes.extras.Parameter):
+            params = [params]
+        sanitized = [self.strip_code(p.value) for p in params]
+        return sanitized[0] if len(sanitized) == 1 else sanitized
 
     def strip_template(self, template, normalize, collapse):
         '''Override to control how templates are stripped in the wikicode.
@@ -74,7 +276,7 @@ class SnippetParserBase(object):
 
         The return value will be the tag's replacement. The default
         implementation replaces <ref> tags with REF_MARKER and handles a few
-        other common tags, delegating other tags to mwparserfromhell.
+        other common tags, stripping other tags like mwparserfromhell does.
         '''
 
         if tag.tag == 'ref':
@@ -90,14 +292,12 @@ class SnippetParserBase(object):
 
         The return value will be the link's replacement. The default value
         will strip the wikilink entirely if its title has a prefix-match in
-        config.wikilink_prefix_blacklist; otherwise, it will delegate to
-        mwparserfromhell.
+        config.wikilink_prefix_blacklist; otherwise, it will strip it like
+        mwparserfromhell does.
         '''
 
-        cfg = config.get_localized_config()
-        for prefix in cfg.wikilink_prefix_blacklist:
-            if wikilink.title.startswith(prefix):
-                return ''
+        if wikilink.title.startswith(self.cfg.wikilink_prefix_blacklist):
+            return ''
         return self.delegate_strip(wikilink, normalize, collapse)
 
     def is_citation_needed(self, template):
@@ -107,7 +307,60 @@ class SnippetParserBase(object):
         config.citation_needed_templates.
         '''
 
-        cfg = config.get_localized_config()
-        return any(
-            template.name.matches(tpl)
-            for tpl in cfg.citation_needed_templates)
+        name = config.normalize_template_name(
+            self.strip_code(template.name).strip())
+        return name in self.cfg.citation_needed_templates_normalized
+
+    def split_article(self, wikitext):
+        '''
+        Split wikitext into sections and paragraphs, like split_sections and
+        split_paragraphs, except that only the paragraphs that may contain a
+        citation needed template get parsed and included, so sections may end
+        up with no paragraphs.
+
+        Returns a list of [title, paragraphs] pairs, starting with the lead
+        section, whose title is empty.
+        '''
+
+        sections = [['', []]]
+        for item in scan_article(wikitext):
+            if not isinstance(item, tuple):
+                sections.append([item, []])
+                continue
+            start, end = item
+            if not self.citation_needed_regexp.search(wikitext, start, end):
+                continue
+            wikicode = mwparserfromhell.parse(wikitext[start:end])
+            for i, (sectitle, nodes) in enumerate(split_sections(wikicode)):
+                # headings the scan missed start new sections
+                if i > 0:
+                    sections.append([sectitle, []])
+                sections[-1][1].extend(split_paragraphs(nodes))
+        return sections
+
+    def extract_snippets(self, wikitext, minlen = 80, maxlen = 560):
+        snippets = [] # [section, [snippets]]
+
+        # Parsing is by far the most expensive step, and most paragraphs have
+        # no citation needed templates, so only parse the ones that might, and
+        # strip each paragraph directly from its nodes.
+        for sectitle, paragraphs in self.split_article(d(wikitext)):
+            secsnippets = []
+            snippets.append([sectitle, secsnippets])
+
+            # Lists cause more 'paragraphs' to be generated, one per line,
+            # which we handle after the ones separated by blank lines.
+            lines = []
+            for paragraph in paragraphs:
+                snippet = cleanup_snippet(self.strip_code(paragraph))
+                if '\n' in snippet:
+                    lines.extend(snippet.split('\n'))
+                    continue
+                if is_usable_snippet(snippet, minlen, maxlen):
+                    secsnippets.append(snippet)
+
+            for line in lines:
+                snippet = cleanup_snippet(line)
+                if is_usable_snippet(snippet, minlen, maxlen):
+                    secsnippets.append(snippet)
+        return snippets
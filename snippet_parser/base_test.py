@@ -0,0 +1,68 @@
+#-*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+
+from base import *
+
+import config
+
+import mwparserfromhell
+
+import unittest
+
+class CreateSnippetParserTest(unittest.TestCase):
+    def setUp(self):
+        self.original_strip_methods = [(klass, klass.__strip__)
+            for klass in (mwparserfromhell.nodes.Template,
+                mwparserfromhell.nodes.Tag, mwparserfromhell.nodes.Wikilink,
+                mwparserfromhell.nodes.Heading)]
+        # create them in both orders, so neither can rely on being last
+        self.en = create_snippet_parser(config.get_localized_config('en'))
+        self.fr = create_snippet_parser(config.get_localized_config('fr'))
+        self.en2 = create_snippet_parser(config.get_localized_config('en'))
+
+    def strip(self, parser, wikitext):
+        return parser.strip_code(mwparserfromhell.parse(wikitext))
+
+    def test_template_handlers_dont_leak(self):
+        wikitext = 'It is {{unité|3|m}} or {{convert|10|ft}} long.'
+        self.assertEqual(self.strip(self.fr, wikitext),
+            'It is 3 m or  long.')
+        for en in (self.en, self.en2):
+            self.assertEqual(self.strip(en, wikitext),
+                'It is  or 10 ft long.')
+
+    def test_citation_needed_templates(self):
+        wikitext = 'Something.{{refnec|vague}}'
+        self.assertEqual(self.strip(self.fr, wikitext),
+            'Something.vague' + CITATION_NEEDED_MARKER)
+        self.assertEqual(self.strip(self.en, wikitext), 'Something.')
+
+    def test_template_names_stripped_by_parser(self):
+        # the comment and the case of the first letter are ignored
+        wikitext = '{{<!-- x -->Unité|3|m}} {{<!-- x -->Convert|10|ft}}'
+        self.assertEqual(self.strip(self.fr, wikitext), '3 m ')
+        self.assertEqual(self.strip(self.en, wikitext), ' 10 ft')
+
+    def test_mwparserfromhell_not_patched(self):
+        for klass, strip in self.original_strip_methods:
+            self.assertEqual(klass.__strip__, strip)
+        self.assertEqual(mwparserfromhell.parse(
+            'It is {{unité|3|m}}<ref>a</ref> long.').strip_code(),
+            'It is a long.')
+
+class ScanArticleTest(unittest.TestCase):
+    def test_heading_inside_pre(self):
+        wikitext = ('Intro.\n<pre>\n== Not a heading ==\n\n{{ code\n</pre>\n'
+            'This needs a source.{{cn}}\n\n== Real ==\nSo does this.{{cn}}')
+        self.assertEqual(
+            [item for item in scan_article(wikitext)
+                if not isinstance(item, tuple)],
+            ['Real'])
+
+        parser = create_snippet_parser(config.get_localized_config('en'))
+        self.assertEqual(parser.extract_snippets(wikitext, 0, float('inf')),
+            [['', ['This needs a source.' + CITATION_NEEDED_MARKER]],
+             ['Real', ['So does this.' + CITATION_NEEDED_MARKER]]])
+
+if __name__ == '__main__':
+    unittest.main()
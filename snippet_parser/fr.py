@@ -3,71 +3,75 @@ from __future__ import unicode_literals
 
 from base import *
 
-def handle_date(template):
+# The handlers below are given the parser, to strip the parameters of
+# templates and match their names with it.
+
+def handle_date(parser, template):
     year = None
     if len(template.params) >= 3:
         try:
-            year = int(sp(template.params[2]))
+            year = int(parser.sp(template.params[2]))
         except ValueError:
             pass
     if isinstance(year, int):
         # assume {{date|d|m|y|...}}
-        return ' '.join(sp(template.params[:3]))
+        return ' '.join(parser.sp(template.params[:3]))
     elif template.params:
         # assume {{date|d m y|...}}
-        return sp(template.params[0])
+        return parser.sp(template.params[0])
     return ''
 
-def handle_s(template):
+def handle_s(parser, template):
     if not template.params:
         return ''
-    ret = sp(template.params[0]).upper()
-    if len(template.params) == 2 and sp(template.params[1]) == 'er':
+    ret = parser.sp(template.params[0]).upper()
+    if len(template.params) == 2 and parser.sp(template.params[1]) == 'er':
         ret += 'ᵉʳ'
     else:
         ret += 'ᵉ'
     if template.name != 'siècle':
         ret += ' siècle'
-    if template.name.matches('-s'):
+    if parser.template_matches(template, '-s'):
         ret += ' av. J.-C'
     return ret
 
-def handle_phonetique(template):
+def handle_phonetique(parser, template):
     if not template.params:
         return ''
-    return sp(template.params[0])
+    return parser.sp(template.params[0])
 
-def handle_citation(template):
+def handle_citation(parser, template):
     if template.params:
-        return '« ' + sp(template.params[0]) + ' »'
+        return '« ' + parser.sp(template.params[0]) + ' »'
 
-def handle_quand(template):
-    return ''.join(sp(p) for p in template.params if not p.showkey)
+def handle_quand(parser, template):
+    return ''.join(parser.sp(p) for p in template.params if not p.showkey)
 
-def handle_lesquelles(template):
+def handle_lesquelles(parser, template):
     # quand and lesquelles are basically the same template
-    return handle_quand(template)
+    return handle_quand(parser, template)
 
 class SnippetParser(SnippetParserBase):
     def strip_template(self, template, normalize, collapse):
-        if template.name.matches('unité'):
-            return ' '.join(sp(template.params[:2]))
-        elif template.name.matches('date'):
-            return handle_date(template)
-        elif matches_any(template, ('s', '-s', 's-', 'siècle')):
-            return handle_s(template)
-        elif template.name.matches('phonétique'):
-            return handle_phonetique(template)
-        elif template.name.matches('citation'):
-            return handle_citation(template)
-        elif template.name.matches('quand'):
-            return handle_quand(template)
-        elif template.name.matches('lesquelles'):
-            return handle_lesquelles(template)
+        if self.template_matches(template, 'unité'):
+            return ' '.join(self.sp(template.params[:2]))
+        elif self.template_matches(template, 'date'):
+            return handle_date(self, template)
+        elif self.template_matches(template, ('s', '-s', 's-', 'siècle')):
+            return handle_s(self, template)
+        elif self.template_matches(template, 'phonétique'):
+            return handle_phonetique(self, template)
+        elif self.template_matches(template, 'citation'):
+            return handle_citation(self, template)
+        elif self.template_matches(template, 'quand'):
+            return handle_quand(self, template)
+        elif self.template_matches(template, 'lesquelles'):
+            return handle_lesquelles(self, template)
         elif self.is_citation_needed(template):
             repl = [CITATION_NEEDED_MARKER]
             # Keep the text inside the template, but not other parameters
             # like date
-            repl = [sp(p) for p in template.params if not p.showkey] + repl
+            repl = [self.sp(p)
+                for p in template.params if not p.showkey] + repl
             return ''.join(repl)
         return ''
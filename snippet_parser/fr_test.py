@@ -5,13 +5,19 @@ import os
 os.environ['CH_LANG'] = 'fr'
 from base import *
 snippet_parser = get_localized_snippet_parser()
+import reference_extractor_test_util as reference_extractor
 
 import unittest
-import functools
 
-# ignore size limits to make these tests
-extract_snippets = functools.partial(
-    snippet_parser.extract_snippets, minlen = 0, maxlen = float('inf'))
+def extract_snippets(text):
+    # ignore size limits to make these tests
+    snippets = snippet_parser.extract_snippets(
+        text, minlen = 0, maxlen = float('inf'))
+    # every test doubles as a check that the single-pass extractor agrees
+    # with the original one
+    assert snippets == reference_extractor.extract_snippets(
+        snippet_parser, text, minlen = 0, maxlen = float('inf')), snippets
+    return snippets
 
 def extract_lead_snippets(text):
     snippets = extract_snippets(text)
@@ -0,0 +1,53 @@
+'''
+A test helper: the original implementation of extract_snippets, which
+splits the wikitext of each section into paragraphs and parses each of them
+again. It is slower, but simple, so the tests use it as a reference for the
+output of the single-pass extractor; nothing else should import it. The
+paragraphs are stripped with the parser passed in, like in the parser's own
+extract_snippets.
+'''
+
+from __future__ import unicode_literals
+
+from base import cleanup_snippet, CITATION_NEEDED_MARKER, REF_MARKER
+from utils import d
+
+import mwparserfromhell
+
+def extract_snippets(parser, wikitext, minlen = 80, maxlen = 560):
+    snippets = [] # [section, [snippets]]
+
+    sections = mwparserfromhell.parse(wikitext).get_sections(
+        include_lead = True, include_headings = True, flat = True)
+    assert ''.join(unicode(s) for s in sections) == d(wikitext)
+
+    for i, section in enumerate(sections):
+        assert i == 0 or \
+            isinstance(section.get(0), mwparserfromhell.nodes.heading.Heading)
+        sectitle = unicode(section.get(0).title.strip()) if i != 0 else ''
+        secsnippets = []
+        snippets.append([sectitle, secsnippets])
+
+        paragraphs = section.split('\n\n')
+        for paragraph in paragraphs:
+            wikicode = mwparserfromhell.parse(paragraph)
+            snippet = cleanup_snippet(parser.strip_code(wikicode))
+            if '\n' in snippet:
+                # Lists cause more 'paragraphs' to be generated
+                paragraphs.extend(snippet.split('\n'))
+                continue
+
+            if CITATION_NEEDED_MARKER not in snippet:
+                # marker may have been inside wiki markup
+                continue
+
+            usable_len = (
+                len(snippet) -
+                (len(CITATION_NEEDED_MARKER) *
+                    snippet.count(CITATION_NEEDED_MARKER)) -
+                (len(REF_MARKER) *
+                    snippet.count(REF_MARKER)))
+            if usable_len > maxlen or usable_len < minlen:
+                continue
+            secsnippets.append(snippet)
+    return snippets
@@ -14,6 +14,13 @@ def d(s):
 def mkid(s):
     return hashlib.sha1(e(s)).hexdigest()[:2*4]
 
+# How many pages to look up or delete per database query
+PAGES_PER_QUERY = 1000
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
 class Logger(object):
     def __init__(self):
         self._mode = 'INFO'